@@ -1 +1,3 @@
 __version__ = '0.1.0'
+
+default_app_config = 'resturo.apps.ResturoConfig'
@@ -0,0 +1,23 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
+
+
+class ResturoConfig(AppConfig):
+    name = 'resturo'
+
+    def ready(self):
+        from .cache import invalidate_membership, invalidate_user_tokens
+        from .models import modelresolver
+
+        User = modelresolver.User
+        post_save.connect(invalidate_user_tokens, sender=User,
+                          dispatch_uid="resturo.cache.invalidate_user_tokens")
+        post_delete.connect(
+            invalidate_user_tokens, sender=User,
+            dispatch_uid="resturo.cache.invalidate_user_tokens")
+
+        Membership = modelresolver("Membership")
+        post_save.connect(invalidate_membership, sender=Membership,
+                          dispatch_uid="resturo.cache.invalidate_membership")
+        post_delete.connect(invalidate_membership, sender=Membership,
+                            dispatch_uid="resturo.cache.invalidate_membership")
@@ -0,0 +1,82 @@
+import jwt
+
+from django.utils.translation import ugettext as _
+
+from rest_framework import exceptions
+from rest_framework_jwt import authentication
+from rest_framework_jwt.settings import api_settings
+
+from .cache import get_token_user_cache
+
+jwt_decode_handler = api_settings.JWT_DECODE_HANDLER
+
+
+class JSONWebTokenAuthentication(authentication.JSONWebTokenAuthentication):
+    """
+        JWT authentication that keeps the decoded payload and the
+        authenticated user on the underlying HttpRequest, so the token is
+        verified and the user loaded only once per request, no matter
+        whether the middleware or the view authenticates first.
+
+        If RESTURO_JWT_USER_CACHE is configured, tokens seen before are
+        resolved from the cache without decoding or a user query.
+    """
+
+    def authenticate(self, request):
+        http_request = getattr(request, '_request', request)
+
+        try:
+            result = http_request._jwt_auth
+        except AttributeError:
+            pass
+        else:
+            if isinstance(result, exceptions.AuthenticationFailed):
+                raise result
+            return result
+
+        try:
+            result = self.authenticate_request(http_request, request)
+        except exceptions.AuthenticationFailed as e:
+            http_request._jwt_auth = e
+            raise
+
+        http_request._jwt_auth = result
+        return result
+
+    def authenticate_request(self, http_request, request):
+        jwt_value = self.get_jwt_value(request)
+        if jwt_value is None:
+            return None
+
+        cache = get_token_user_cache()
+        if cache is not None:
+            cached = cache.get(jwt_value)
+            if cached is not None:
+                http_request._jwt_payload, user = cached
+                return (user, jwt_value)
+
+        try:
+            payload = jwt_decode_handler(jwt_value)
+        except jwt.ExpiredSignature:
+            msg = _('Signature has expired.')
+            raise exceptions.AuthenticationFailed(msg)
+        except jwt.DecodeError:
+            msg = _('Error decoding signature.')
+            raise exceptions.AuthenticationFailed(msg)
+        except jwt.InvalidTokenError:
+            raise exceptions.AuthenticationFailed()
+
+        http_request._jwt_payload = payload
+
+        # read the generation before loading the user, a change in between
+        # then invalidates the entry we're about to store
+        user_id = payload.get('user_id')
+        generation = None
+        if cache is not None and user_id is not None:
+            generation = cache.generation(user_id)
+
+        user = self.authenticate_credentials(payload)
+
+        if generation is not None and str(user.pk) == str(user_id):
+            cache.set(jwt_value, payload, user, generation)
+        return (user, jwt_value)
@@ -0,0 +1,51 @@
+from django.db import connections, router, transaction
+
+
+def backfill_token(EmailVerification):
+    """ The token of backfilled verifications: NULL once the token column
+        is nullable (migration 0003), '' before. The database is checked
+        rather than the model, the backfill may run before migrating.
+    """
+    field = EmailVerification._meta.get_field('token')
+    connection = connections[router.db_for_write(EmailVerification)]
+    with connection.cursor() as cursor:
+        for column in connection.introspection.get_table_description(
+                cursor, EmailVerification._meta.db_table):
+            if column.name == field.column:
+                return None if column.null_ok else ''
+    return None
+
+
+def backfill_email_verification(User, EmailVerification, batch_size=1000,
+                                start=0, progress=None):
+    """ Create a verified EmailVerification for every user without one.
+
+        The user table is walked in primary key ranges of batch_size users;
+        users lacking a verification are found with an anti-join and their
+        verifications are created with a single bulk insert per range.
+        Every range is committed separately, so the backfill can be
+        resumed by passing the last reported pk as start. Models are
+        passed in so migrations can use their historical versions.
+
+        Returns the last pk that has been processed.
+    """
+    last = start
+    token = backfill_token(EmailVerification)
+
+    while True:
+        pks = list(User.objects.filter(pk__gt=last).order_by('pk')
+                   .values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return last
+
+        with transaction.atomic():
+            missing = User.objects.filter(
+                pk__gt=last, pk__lte=pks[-1],
+                verification__isnull=True).values_list('pk', flat=True)
+            EmailVerification.objects.bulk_create(
+                [EmailVerification(user_id=pk, verified=True, token=token)
+                 for pk in missing])
+
+        last = pks[-1]
+        if progress is not None:
+            progress(last)
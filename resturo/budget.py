@@ -0,0 +1,152 @@
+import logging
+import time
+import traceback
+
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.utils import CursorWrapper
+
+logger = logging.getLogger('resturo.budget')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RecordingCursorWrapper(CursorWrapper):
+    """ Report every query, its duration and the stack that ran it to the
+        active QueryRecorders of the connection """
+
+    def __init__(self, cursor, db, recorders):
+        super().__init__(cursor, db)
+        self.recorders = recorders
+
+    def record(self, sql, start):
+        duration = time.perf_counter() - start
+        stack = None
+        if any(recorder.stacks for recorder in self.recorders):
+            stack = traceback.extract_stack()[:-2]
+        for recorder in self.recorders:
+            recorder.record(sql, duration, stack)
+
+    def execute(self, sql, params=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.record(sql, start)
+
+    def executemany(self, sql, param_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, param_list)
+        finally:
+            self.record(sql, start)
+
+
+class QueryRecorder(object):
+    """ Record the queries run on a database connection between start()
+        and stop() (or within a with block), with their total duration
+        and, if stacks is set, the stack that ran them. Recorders may be
+        nested and overlap.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, stacks=True):
+        self.using = using
+        self.stacks = stacks
+        self.queries = []
+        self.time = 0.0
+
+    def __len__(self):
+        return len(self.queries)
+
+    def record(self, sql, duration, stack):
+        self.queries.append((sql, stack if self.stacks else None))
+        self.time += duration
+
+    def start(self):
+        connection = connections[self.using]
+        recorders = connection.__dict__.setdefault('_resturo_recorders', [])
+        if not recorders:
+            # wrap both, whether queries are logged may change while
+            # recording (e.g. by CaptureQueriesContext)
+            make_cursor = connection.make_cursor
+            make_debug_cursor = connection.make_debug_cursor
+            connection.make_cursor = (
+                lambda cursor: RecordingCursorWrapper(
+                    make_cursor(cursor), connection, recorders))
+            connection.make_debug_cursor = (
+                lambda cursor: RecordingCursorWrapper(
+                    make_debug_cursor(cursor), connection, recorders))
+        recorders.append(self)
+        return self
+
+    def stop(self):
+        connection = connections[self.using]
+        recorders = connection._resturo_recorders
+        if self in recorders:
+            recorders.remove(self)
+            if not recorders:
+                del connection.make_cursor
+                del connection.make_debug_cursor
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def format(self):
+        """ the recorded queries with their stacks, for reporting """
+        return '\n'.join(
+            '{0}. {1}\n{2}'.format(i, sql,
+                                   ''.join(traceback.format_list(stack)))
+            for i, (sql, stack) in enumerate(self.queries, 1))
+
+
+def get_query_budget(view, method):
+    """ Return the query budget of view (a view class or a view function
+        created by as_view()) for the HTTP method, or None if it has none.
+
+        A view's query_budget is either the maximum number of queries for
+        every method or a dict mapping methods to their maximum. The
+        budgets of the resturo views are measured in tests: they include
+        session authentication (two queries), the savepoint queries of
+        transactions within the test's transaction and, with
+        RESTURO_SIGNAL_OUTBOX and RESTURO_VERIFY_EMAIL, the inserts of
+        the signal events and email verifications.
+    """
+    view = getattr(view, 'view_class', view)
+    budget = getattr(view, 'query_budget', None)
+    if isinstance(budget, dict):
+        budget = budget.get(method.upper())
+    return budget
+
+
+def check_query_budget(name, budget, recorder):
+    """ raise QueryBudgetExceeded if recorder recorded more than budget
+        queries """
+    if len(recorder) > budget:
+        raise QueryBudgetExceeded(
+            "{0} ran {1} queries, budget is {2}:\n{3}".format(
+                name, len(recorder), budget, recorder.format()))
+
+
+@contextmanager
+def assert_query_budget(view, method, using=DEFAULT_DB_ALIAS):
+    """ Raise QueryBudgetExceeded if the block runs more queries than the
+        budget of view for method allows, e.g. in tests:
+
+            with assert_query_budget(UserDetailView, 'PATCH'):
+                self.client.patch(url, data)
+    """
+    budget = get_query_budget(view, method)
+    if budget is None:
+        raise ValueError("{0} has no query budget for {1}".format(
+            getattr(view, '__name__', view), method))
+
+    with QueryRecorder(using) as recorder:
+        yield recorder
+    check_query_budget('{0} {1}'.format(method.upper(), view.__name__),
+                       budget, recorder)
@@ -0,0 +1,257 @@
+import hashlib
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import router
+from django.dispatch import receiver
+from django.utils.encoding import force_bytes
+from django.utils.module_loading import import_string
+
+try:
+    from django.db.models.query_utils import deferred_class_factory
+except ImportError:  # Django 1.10+, from_db defers missing fields
+    deferred_class_factory = None
+
+from .models import modelresolver
+
+
+class LocalLRU(object):
+    """ A small in-process LRU with a per entry time to live.
+
+        Entries expire quickly so invalidations in other processes (which
+        only reach the shared cache) become visible within `timeout`
+        seconds.
+    """
+
+    def __init__(self, maxsize=1024, timeout=5):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.data = OrderedDict()
+        # reads reorder the entries, threads share the LRU
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                return None
+
+            if expires < time.time():
+                del self.data[key]
+                return None
+
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.time() + self.timeout, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class MembershipCache(object):
+    """ Cache the memberships of a user as a mapping of organization id
+        to role.
+
+        Lookups go through a local LRU first, then Django's cache framework
+        and only then the database. Entries are invalidated when a
+        Membership is saved or deleted.
+    """
+    prefix = 'resturo.memberships'
+
+    def __init__(self, alias=None, timeout=None, local_maxsize=None,
+                 local_timeout=None):
+        self.alias = alias or getattr(
+            settings, "RESTURO_MEMBERSHIP_CACHE_ALIAS", 'default')
+        self.timeout = timeout or getattr(
+            settings, "RESTURO_MEMBERSHIP_CACHE_TIMEOUT", 300)
+        self.local = LocalLRU(
+            maxsize=local_maxsize or getattr(
+                settings, "RESTURO_MEMBERSHIP_CACHE_LOCAL_SIZE", 1024),
+            timeout=local_timeout or getattr(
+                settings, "RESTURO_MEMBERSHIP_CACHE_LOCAL_TIMEOUT", 5))
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, user_id):
+        return '{0}:{1}'.format(self.prefix, user_id)
+
+    def load(self, user_id):
+        """ fetch the memberships for user_id from the database """
+        return dict(modelresolver.models.Membership.objects.filter(
+            user_id=user_id).values_list('organization_id', 'role'))
+
+    def get(self, user_id):
+        """ return {organization_id: role} for user_id """
+        key = self.key(user_id)
+
+        memberships = self.local.get(key)
+        if memberships is not None:
+            return memberships
+
+        memberships = self.cache.get(key)
+        if memberships is None:
+            memberships = self.load(user_id)
+            self.cache.set(key, memberships, self.timeout)
+
+        self.local.set(key, memberships)
+        return memberships
+
+    def role(self, user_id, organization_id):
+        """ return the role of user_id in organization_id, or None if
+            the user is not a member """
+        return self.get(user_id).get(organization_id)
+
+    def invalidate(self, user_id):
+        key = self.key(user_id)
+        self.local.delete(key)
+        self.cache.delete(key)
+
+
+class TokenUserCache(object):
+    """ Cache the user (and decoded payload) a JWT resolves to, keyed by
+        a hash of the token and never beyond the token's expiration.
+
+        Every user has a generation stored next to the cached tokens;
+        invalidating a user replaces the generation, which makes all
+        tokens cached for that user miss. Read the generation before
+        loading the user, so a change in between isn't cached as current.
+
+        Users are stored as field values, without the password hash; the
+        cached user loads it on access.
+    """
+    prefix = 'resturo.jwtuser'
+    excluded_fields = ('password',)
+
+    def __init__(self, alias=None, timeout=None):
+        self.alias = alias or getattr(
+            settings, "RESTURO_JWT_USER_CACHE_ALIAS", 'default')
+        self.timeout = timeout or getattr(
+            settings, "RESTURO_JWT_USER_CACHE_TIMEOUT", 300)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def token_key(self, token):
+        return '{0}:token:{1}'.format(
+            self.prefix, hashlib.sha256(force_bytes(token)).hexdigest())
+
+    def generation_key(self, user_id):
+        return '{0}:generation:{1}'.format(self.prefix, user_id)
+
+    def generation(self, user_id):
+        key = self.generation_key(user_id)
+        self.cache.add(key, uuid.uuid4().hex, None)
+        return self.cache.get(key)
+
+    def field_names(self):
+        return [f.attname for f in get_user_model()._meta.concrete_fields
+                if f.name not in self.excluded_fields]
+
+    def get(self, token):
+        """ return (payload, user) for token or None on a miss """
+        entry = self.cache.get(self.token_key(token))
+        if entry is None:
+            return None
+
+        generation, payload, user_id, values = entry
+        if self.cache.get(self.generation_key(user_id)) != generation:
+            return None
+
+        User = get_user_model()
+        if deferred_class_factory is not None:
+            User = deferred_class_factory(User, set(self.excluded_fields))
+        user = User.from_db(router.db_for_read(User), self.field_names(),
+                            values)
+        return payload, user
+
+    def set(self, token, payload, user, generation):
+        """ cache user for token, if generation (read before the user was
+            loaded) is still current """
+        timeout = self.timeout
+        if 'exp' in payload:
+            timeout = min(timeout, int(payload['exp'] - time.time()))
+        if timeout <= 0 or generation is None:
+            return
+
+        values = [getattr(user, name) for name in self.field_names()]
+        self.cache.set(self.token_key(token),
+                       (generation, payload, user.pk, values), timeout)
+
+    def invalidate(self, user_id):
+        self.cache.set(self.generation_key(user_id), uuid.uuid4().hex, None)
+
+
+_membership_cache = None
+_token_user_cache = None
+
+
+def get_membership_cache():
+    """ return the configured membership cache, or None if
+        RESTURO_MEMBERSHIP_CACHE is not set """
+    global _membership_cache
+
+    path = getattr(settings, "RESTURO_MEMBERSHIP_CACHE", None)
+    if not path:
+        return None
+
+    if _membership_cache is None:
+        _membership_cache = import_string(path)()
+    return _membership_cache
+
+
+def get_token_user_cache():
+    """ return the configured JWT user cache, or None if
+        RESTURO_JWT_USER_CACHE is not set """
+    global _token_user_cache
+
+    path = getattr(settings, "RESTURO_JWT_USER_CACHE", None)
+    if not path:
+        return None
+
+    if _token_user_cache is None:
+        _token_user_cache = import_string(path)()
+    return _token_user_cache
+
+
+@receiver(setting_changed, dispatch_uid="resturo.cache.reset_caches")
+def reset_caches(setting, **kwargs):
+    global _membership_cache, _token_user_cache
+
+    if setting.startswith("RESTURO_MEMBERSHIP_CACHE"):
+        _membership_cache = None
+    if setting.startswith("RESTURO_JWT_USER_CACHE"):
+        _token_user_cache = None
+
+
+def invalidate_membership(sender, instance, **kwargs):
+    cache = get_membership_cache()
+    if cache is not None:
+        cache.invalidate(instance.user_id)
+
+
+def invalidate_user_tokens(sender, instance, **kwargs):
+    cache = get_token_user_cache()
+    if cache is not None:
+        cache.invalidate(instance.pk)
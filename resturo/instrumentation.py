@@ -0,0 +1,139 @@
+import logging
+import socket
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.encoding import force_bytes
+from django.utils.module_loading import import_string
+
+from .budget import QueryRecorder
+
+logger = logging.getLogger('resturo.metrics')
+
+
+class MemorySink(object):
+    """ Keep metrics in memory, for tests """
+
+    def __init__(self):
+        self.metrics = []
+
+    def timing(self, name, value):
+        self.metrics.append(('timing', name, value))
+
+    def count(self, name, value):
+        self.metrics.append(('count', name, value))
+
+    def values(self, name):
+        """ the values recorded for name """
+        return [value for _, n, value in self.metrics if n == name]
+
+    def clear(self):
+        self.metrics = []
+
+
+class LoggingSink(object):
+    """ Log metrics to the resturo.metrics logger """
+
+    def __init__(self, level=None):
+        self.level = level or getattr(settings, "RESTURO_METRICS_LOG_LEVEL",
+                                      logging.INFO)
+
+    def timing(self, name, value):
+        logger.log(self.level, "%s %.3fms", name, value)
+
+    def count(self, name, value):
+        logger.log(self.level, "%s %d", name, value)
+
+
+class StatsdSink(object):
+    """ Send metrics to a StatsD server over UDP, at
+        RESTURO_STATSD_HOST:RESTURO_STATSD_PORT with RESTURO_STATSD_PREFIX.
+        Failures to send are ignored.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (
+            host or getattr(settings, "RESTURO_STATSD_HOST", 'localhost'),
+            port or getattr(settings, "RESTURO_STATSD_PORT", 8125))
+        self.prefix = prefix or getattr(settings, "RESTURO_STATSD_PREFIX",
+                                        'resturo')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind):
+        data = '{0}.{1}:{2}|{3}'.format(self.prefix, name, value, kind)
+        try:
+            self.socket.sendto(force_bytes(data), self.address)
+        except (OSError, socket.error):
+            pass
+
+    def timing(self, name, value):
+        self.send(name, '{0:.3f}'.format(value), 'ms')
+
+    def count(self, name, value):
+        self.send(name, value, 'c')
+
+
+_sinks = None
+
+
+def get_sinks():
+    """ return the sinks configured by RESTURO_METRICS_SINKS, a list of
+        dotted paths """
+    global _sinks
+
+    if _sinks is None:
+        _sinks = [import_string(path)() for path in
+                  getattr(settings, "RESTURO_METRICS_SINKS", ())]
+    return _sinks
+
+
+@receiver(setting_changed, dispatch_uid="resturo.instrumentation.reset_sinks")
+def reset_sinks(setting, **kwargs):
+    global _sinks
+
+    if setting.startswith("RESTURO_METRICS") or \
+            setting.startswith("RESTURO_STATSD"):
+        _sinks = None
+
+
+@contextmanager
+def measure(name, queries=False):
+    """ Record the wall time of the block in milliseconds as <name>.time
+        and, if queries is set, the time spent in the database as
+        <name>.db_time and the number of queries as <name>.queries.
+
+        Does nothing if no sinks are configured.
+    """
+    sinks = get_sinks()
+    if not sinks:
+        yield
+        return
+
+    recorder = QueryRecorder(stacks=False).start() if queries else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        if recorder is not None:
+            recorder.stop()
+
+        for sink in sinks:
+            sink.timing(name + '.time', elapsed)
+            if recorder is not None:
+                sink.timing(name + '.db_time', recorder.time * 1000)
+                sink.count(name + '.queries', len(recorder))
+
+
+class InstrumentedViewMixin(object):
+    """ measure view.<view class>.<method> for every request """
+
+    def dispatch(self, request, *args, **kwargs):
+        with measure('view.{0}.{1}'.format(type(self).__name__,
+                                           request.method),
+                     queries=True):
+            return super().dispatch(request, *args, **kwargs)
@@ -0,0 +1,100 @@
+import logging
+import threading
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template import loader
+from django.utils import translation
+
+logger = logging.getLogger('resturo.mail')
+
+_templates = {}
+_local = threading.local()
+
+
+def get_template(name, language):
+    """ Return the compiled template resturo/email/<name> for language,
+        preferring resturo/email/<language>/<name>. Templates are compiled
+        once per name and language.
+    """
+    key = (name, language)
+    try:
+        return _templates[key]
+    except KeyError:
+        pass
+
+    template = loader.select_template([
+        'resturo/email/{0}/{1}'.format(language, name),
+        'resturo/email/{0}'.format(name)])
+    _templates[key] = template
+    return template
+
+
+@receiver(setting_changed, dispatch_uid="resturo.mail.clear_templates")
+def clear_templates(setting, **kwargs):
+    if setting == "TEMPLATES":
+        _templates.clear()
+
+
+def render_mail(name, context, to, language=None):
+    """ Build an EmailMessage from the resturo/email/<name>_subject.txt and
+        <name>_body.txt templates """
+    language = (language or translation.get_language() or
+                settings.LANGUAGE_CODE)
+    context = dict(context,
+                   site_url=getattr(settings, "RESTURO_SITE_URL", ''))
+
+    with translation.override(language):
+        subject = get_template(name + '_subject.txt', language).render(
+            context)
+        body = get_template(name + '_body.txt', language).render(context)
+
+    return EmailMessage(' '.join(subject.split()), body,
+                        settings.DEFAULT_FROM_EMAIL, to)
+
+
+def send_messages(messages):
+    """ send messages over a single connection """
+    get_connection().send_messages(messages)
+
+
+def queue_mail(message):
+    """ Send message, or, within a mail_batch() block, queue it to be sent
+        with the rest of the batch """
+    queued = getattr(_local, 'messages', None)
+    if queued is None:
+        send_messages([message])
+    else:
+        queued.append(message)
+
+
+@contextmanager
+def mail_batch(fail_silently=False):
+    """ Collect all mails queued within the block and send them over one
+        connection when the block exits without an exception. Nested
+        blocks join the outermost batch. With fail_silently, errors
+        sending the mails are logged instead of raised.
+    """
+    if getattr(_local, 'messages', None) is not None:
+        yield
+        return
+
+    _local.messages = []
+    try:
+        yield
+        messages = _local.messages
+    finally:
+        _local.messages = None
+
+    if not messages:
+        return
+    try:
+        send_messages(messages)
+    except Exception:
+        if not fail_silently:
+            raise
+        logger.exception("Sending %d mails failed", len(messages))
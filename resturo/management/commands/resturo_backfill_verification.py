@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+
+from resturo.backfill import backfill_email_verification
+from resturo.models import EmailVerification
+
+
+class Command(BaseCommand):
+    help = ("Mark all users without an email verification as verified. "
+            "Can be run online, before migrating, and resumed with --start.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="users per batch (default 1000)")
+        parser.add_argument('--start', type=int, default=0,
+                            help="resume after this user pk")
+
+    def handle(self, *args, **options):
+        def progress(pk):
+            self.stdout.write("processed users up to pk {0}".format(pk))
+
+        last = backfill_email_verification(
+            get_user_model(), EmailVerification,
+            batch_size=options['batch_size'], start=options['start'],
+            progress=progress if options['verbosity'] > 1 else None)
+        self.stdout.write("done, last pk {0}".format(last))
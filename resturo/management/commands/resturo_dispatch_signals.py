@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from resturo.signals import dispatch_outbox
+
+
+class Command(BaseCommand):
+    help = ("Deliver resturo signals stored in the outbox "
+            "(RESTURO_SIGNAL_OUTBOX).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="events per transaction (default 100)")
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help="give up on an event after this many "
+                                 "failed deliveries (default 5)")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="seconds to sleep when the outbox is empty")
+        parser.add_argument('--once', action='store_true',
+                            help="exit once the outbox is empty")
+
+    def handle(self, *args, **options):
+        while True:
+            handled = dispatch_outbox(batch_size=options['batch_size'],
+                                      max_attempts=options['max_attempts'])
+            if handled:
+                if options['verbosity'] > 1:
+                    self.stdout.write("handled {0} events".format(handled))
+                continue
+
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -1,11 +1,19 @@
+import random
+
 from rest_framework.request import Request
 
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
+from django.utils.functional import SimpleLazyObject
 
-from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 
+from .authentication import JSONWebTokenAuthentication
 from .models import modelresolver
+from .cache import get_membership_cache
+from .budget import QueryBudgetExceeded, QueryRecorder
+from .budget import check_query_budget, get_query_budget, logger
+from .instrumentation import measure
 
 
 def get_user_jwt(request):
@@ -29,44 +37,153 @@ def get_user_jwt(request):
     return user
 
 
+def get_organization(request):
+    """
+        Find the organization for the current user based on the
+        Organization:-header.
+
+        Users can only select an organization they have access to (unless
+        they are superuser). If no header is found, predictably select an
+        organization the user belongs to. Returns None if no organization
+        can be selected.
+    """
+    Organization = modelresolver.models.Organization
+    Membership = modelresolver.models.Membership
+
+    user = get_user_jwt(request)
+    if not user or user.is_anonymous():
+        return None
+
+    organizationid = request.META.get('HTTP_ORGANIZATION')
+    cache = get_membership_cache()
+
+    if organizationid and organizationid != 'null':
+        try:
+            organizationid = int(organizationid)
+            if not (user.is_superuser or
+                    Membership.is_member(user, organizationid)):
+                # distinguish between "no access" and "no such
+                # organization"
+                if Organization.objects.filter(pk=organizationid).exists():
+                    raise PermissionDenied(
+                        "You are not part of that organization")
+                raise Organization.DoesNotExist
+            return Organization.objects.get(pk=organizationid)
+        except ValueError:
+            pass
+        except Organization.DoesNotExist:
+            pass
+    elif cache is not None:
+        memberships = cache.get(user.pk)
+        if memberships:
+            try:
+                return Organization.objects.get(pk=max(memberships))
+            except Organization.DoesNotExist:
+                pass
+    else:
+        try:
+            return user.organizations.latest('pk')
+        except Organization.DoesNotExist:
+            pass
+    return None
+
+
+def has_credentials(request):
+    """ Whether get_user_jwt may find a user: request.user is authenticated
+        or the request carries a JWT. The token is not verified, a
+        malformed JWT header counts as credentials so get_user_jwt
+        rejects it with PermissionDenied. """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return True
+    try:
+        return JSONWebTokenAuthentication().get_jwt_value(
+            Request(request)) is not None
+    except AuthenticationFailed:
+        return True
+
+
 class SelectOrganizationMiddleware(object):
 
     def process_request(self, request):
         """
-            Find and set the organization for the current user based on
-            the Organization:-header.
-
-            Users can only set an organizations they have access to (unless
-            they are superuser). If no header is found, predictably set the
-            organization to one the user belongs to.
+            Set request.organization to the organization selected by
+            get_organization. Resolution is deferred until the attribute
+            is first used, unless the path starts with one of
+            RESTURO_ORGANIZATION_EAGER_PATHS.
+
+            The attribute is not set for anonymous requests (or, on eager
+            paths, if no organization is selected). Deferred, it is a lazy
+            proxy that may wrap None: test it with `if request.organization`,
+            `request.organization is None` is never true.
         """
-        Organization = modelresolver("Organization")
-        Membership = modelresolver("Membership")
-
-        user = get_user_jwt(request)
-        if not user or user.is_anonymous():
+        if not has_credentials(request):
             return
 
-        organizationid = request.META.get('HTTP_ORGANIZATION')
-
-        if organizationid and organizationid != 'null':
-            try:
-                organizationid = int(organizationid)
-                organization = Organization.objects.get(
-                    pk=organizationid)
-                if not (user.is_superuser or
-                        Membership.objects.filter(
-                        organization__id=organizationid,
-                            user=user).exists()):
-                    raise PermissionDenied(
-                        "You are not part of that organization")
+        eager_paths = tuple(getattr(settings,
+                                    "RESTURO_ORGANIZATION_EAGER_PATHS", ()))
+        if eager_paths and request.path.startswith(eager_paths):
+            organization = self.get_organization(request)
+            if organization is not None:
                 request.organization = organization
-            except ValueError:
-                pass
-            except Organization.DoesNotExist:
-                pass
         else:
-            try:
-                request.organization = user.organizations.latest('pk')
-            except Organization.DoesNotExist:
-                pass
+            request.organization = SimpleLazyObject(
+                lambda: self.get_organization(request))
+
+    def get_organization(self, request):
+        with measure('middleware.SelectOrganizationMiddleware',
+                     queries=True):
+            return get_organization(request)
+
+
+class QueryBudgetMiddleware(object):
+    """
+        Check the number of queries of views with a query_budget (see
+        resturo.budget.get_query_budget), depending on RESTURO_QUERY_BUDGET:
+
+        'raise': raise QueryBudgetExceeded when a view exceeds its budget
+        'log': log violations, with the stack of every query, to the
+               resturo.budget logger for a RESTURO_QUERY_BUDGET_SAMPLE_RATE
+               fraction of the requests
+
+        Nothing is checked if RESTURO_QUERY_BUDGET is not set.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        mode = getattr(settings, "RESTURO_QUERY_BUDGET", None)
+        if not mode:
+            return None
+
+        budget = get_query_budget(view_func, request.method)
+        if budget is None:
+            return None
+
+        rate = getattr(settings, "RESTURO_QUERY_BUDGET_SAMPLE_RATE", 1.0)
+        if mode == 'log' and random.random() >= rate:
+            return None
+
+        request._query_budget = (
+            '{0} {1}'.format(request.method, view_func.__name__), budget,
+            QueryRecorder().start())
+        return None
+
+    def process_exception(self, request, exception):
+        """ views that fail aren't checked """
+        budget = request.__dict__.pop('_query_budget', None)
+        if budget is not None:
+            budget[2].stop()
+
+    def process_response(self, request, response):
+        budget = request.__dict__.pop('_query_budget', None)
+        if budget is None:
+            return response
+
+        name, budget, recorder = budget
+        recorder.stop()
+        try:
+            check_query_budget(name, budget, recorder)
+        except QueryBudgetExceeded as e:
+            if getattr(settings, "RESTURO_QUERY_BUDGET", None) == 'raise':
+                raise
+            logger.warning("%s %s", request.path, e)
+        return response
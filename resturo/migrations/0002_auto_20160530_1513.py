@@ -2,18 +2,19 @@
 # Generated by Django 1.9.2 on 2016-05-30 13:13
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.db import migrations
 
+from resturo.backfill import backfill_email_verification
+
 
 def set_email_verification(apps, schema_editor):
     User = apps.get_model("auth", "user")
     EmailVerification = apps.get_model("resturo", "EmailVerification")
 
-    for u in User.objects.all():
-        ev, created = EmailVerification.objects.get_or_create(user=u)
-        if created:
-            ev.verified = True
-            ev.save()
+    backfill_email_verification(
+        User, EmailVerification,
+        batch_size=getattr(settings, "RESTURO_BACKFILL_BATCH_SIZE", 1000))
 
 
 class Migration(migrations.Migration):
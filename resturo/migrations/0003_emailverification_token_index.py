@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def clear_empty_tokens(apps, schema_editor):
+    """ unset tokens are stored as NULL so they don't collide in the
+        unique index """
+    EmailVerification = apps.get_model("resturo", "EmailVerification")
+    EmailVerification.objects.filter(token='').update(token=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('resturo', '0002_auto_20160530_1513'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emailverification',
+            name='token',
+            field=models.CharField(default=None, max_length=36, null=True),
+        ),
+        migrations.RunPython(clear_empty_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='emailverification',
+            name='token',
+            field=models.CharField(default=None, max_length=36, null=True, unique=True),
+        ),
+    ]
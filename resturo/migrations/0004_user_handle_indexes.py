@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import migrations
+
+INDEXES = (
+    ('resturo_user_email_lower', 'email'),
+    ('resturo_user_username_lower', 'username'),
+)
+
+# vendors that support indexes on expressions
+VENDORS = ('postgresql', 'sqlite')
+
+# Creating the indexes locks the user table against writes while they are
+# built. For large tables on PostgreSQL, create them by hand beforehand,
+#
+#     CREATE INDEX CONCURRENTLY resturo_user_email_lower
+#         ON auth_user (LOWER(email));
+#     CREATE INDEX CONCURRENTLY resturo_user_username_lower
+#         ON auth_user (LOWER(username));
+#
+# and mark this migration as applied:
+#
+#     python manage.py migrate resturo 0004 --fake
+#
+# Django < 1.10 always runs PostgreSQL migrations in a transaction, which
+# CREATE INDEX CONCURRENTLY doesn't allow.
+
+
+def handle_columns(apps):
+    """ (index name, column) for the handle fields the (swappable) user
+        model has """
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    for name, field in INDEXES:
+        try:
+            yield name, User._meta.get_field(field).column
+        except FieldDoesNotExist:
+            pass
+
+
+def create_handle_indexes(apps, schema_editor):
+    """ index LOWER(email) and LOWER(username) on the user table so
+        handle lookups don't need a sequential scan """
+    if schema_editor.connection.vendor not in VENDORS:
+        return
+
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    table = schema_editor.quote_name(User._meta.db_table)
+    for name, column in handle_columns(apps):
+        schema_editor.execute('CREATE INDEX {0} ON {1} (LOWER({2}))'.format(
+            schema_editor.quote_name(name), table,
+            schema_editor.quote_name(column)))
+
+
+def drop_handle_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in VENDORS:
+        return
+
+    for name, column in handle_columns(apps):
+        schema_editor.execute('DROP INDEX IF EXISTS {0}'.format(
+            schema_editor.quote_name(name)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('resturo', '0003_emailverification_token_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_handle_indexes, drop_handle_indexes),
+    ]
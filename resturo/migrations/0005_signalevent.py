@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 01:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('resturo', '0004_user_handle_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SignalEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('signal', models.CharField(max_length=64)),
+                ('payload', models.TextField()),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('available', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('attempts', models.IntegerField(default=0)),
+                ('failed', models.BooleanField(default=False)),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+        ),
+    ]
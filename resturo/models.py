@@ -1,17 +1,47 @@
 import uuid
 
 from django.db import models
+from django.utils import timezone
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.core.signals import setting_changed
 
 from django.conf import settings
 from django.apps import apps
 from django.core.exceptions import ImproperlyConfigured
 
 
+class ResolvedModels(object):
+    """ Attribute access to resolved model classes, e.g.
+        modelresolver.models.Membership
+    """
+
+    def __init__(self, resolver):
+        self._resolver = resolver
+
+    def __getattr__(self, name):
+        return self._resolver(name)
+
+
 class ModelResolver(object):
+    """ Resolve configurable models. Attribute access (modelresolver.User)
+        gives the 'app_label.ModelName' path, calling (or .models) gives
+        the model class. Resolved classes are cached per process.
+    """
+
+    def __init__(self):
+        self.resolved = {}
+        self.models = ResolvedModels(self)
+
+    def clear(self):
+        self.resolved.clear()
 
     def __call__(self, name):
+        try:
+            return self.resolved[name]
+        except KeyError:
+            pass
+
         model_path = getattr(self, name)
 
         try:
@@ -26,6 +56,7 @@ class ModelResolver(object):
                 "{0} refers to model '{1}' that has not been "
                 "installed".format(name, model_path))
 
+        self.resolved[name] = model
         return model
 
     def __getattr__(self, name):
@@ -48,6 +79,12 @@ class ModelResolver(object):
 modelresolver = ModelResolver()
 
 
+@receiver(setting_changed, dispatch_uid="resturo.models.clear_modelresolver")
+def clear_modelresolver(setting, **kwargs):
+    if setting in ("MODELS", "AUTH_USER_MODEL"):
+        modelresolver.clear()
+
+
 class Organization(models.Model):
 
     class Meta:
@@ -65,28 +102,58 @@ class Organization(models.Model):
 
 
 class Membership(models.Model):
+    """ Concrete subclasses that declare their own Meta should extend
+        Membership.Meta to keep the (user, organization) constraint """
 
     class Meta:
         abstract = True
+        # also serves as index for lookups on user and (user, organization)
+        unique_together = (('user', 'organization'),)
 
     user = models.ForeignKey(modelresolver.User)
     organization = models.ForeignKey(modelresolver.Organization)
     role = models.IntegerField(default=0)
 
+    @classmethod
+    def is_member(cls, user, organization):
+        """ Check if user is a member of organization, both given as
+            instance or pk. Uses the membership cache if configured,
+            a single EXISTS query otherwise.
+        """
+        from .cache import get_membership_cache
+
+        user_id = getattr(user, 'pk', user)
+        organization_id = int(getattr(organization, 'pk', organization))
+
+        cache = get_membership_cache()
+        if cache is not None:
+            return organization_id in cache.get(user_id)
+
+        return cls.objects.filter(user_id=user_id,
+                                  organization_id=organization_id).exists()
+
 
 class EmailVerification(models.Model):
     user = models.OneToOneField(modelresolver.User,
                                 related_name="verification")
     previous = models.EmailField(default='')
     verified = models.BooleanField(default=False)
-    token = models.CharField(max_length=36, default='')
+    # tokens are stored lowercase so lookups can use the unique index
+    token = models.CharField(max_length=36, null=True, unique=True,
+                             default=None)
 
     def reset(self):
         """ reset verification, meaning state becomes unverified
-            and a new token is genereated
+            and a new token is genereated. Stateless (signed) tokens
+            aren't stored.
         """
+        from .tokens import is_stateless_verification
+
         self.verified = False
-        self.token = str(uuid.uuid4())
+        if is_stateless_verification():
+            self.token = None
+        else:
+            self.token = str(uuid.uuid4())
         self.save()
 
 
@@ -102,7 +169,7 @@ class Invite(models.Model):
     email = models.EmailField(blank=True)
     strict = models.BooleanField(default=False)
     role = models.IntegerField(default=0)
-    token = models.CharField(max_length=36, default='')
+    token = models.CharField(max_length=36, default='', unique=True)
 
     def save(self, *args, **kwargs):
         if self.pk is None and self.token == '':
@@ -110,6 +177,26 @@ class Invite(models.Model):
         return super().save(*args, **kwargs)
 
 
+class SignalEvent(models.Model):
+    """ A resturo signal stored for delivery by the resturo_dispatch_signals
+        command (see RESTURO_SIGNAL_OUTBOX) """
+    signal = models.CharField(max_length=64)
+    payload = models.TextField()
+    created = models.DateTimeField(default=timezone.now)
+    available = models.DateTimeField(default=timezone.now, db_index=True)
+    attempts = models.IntegerField(default=0)
+    failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True, default='')
+
+
+class RevokedInvite(models.Model):
+    """ The id of a signed invite token (see RESTURO_INVITE_STATELESS) that
+        was cancelled or has been used. Rows older than
+        RESTURO_INVITE_MAX_AGE may be deleted. """
+    jti = models.CharField(max_length=32, unique=True)
+    created = models.DateTimeField(default=timezone.now)
+
+
 @receiver(post_save, sender=modelresolver.User,
           dispatch_uid="resturo.models.reset_verification")
 def reset_verification(sender, instance, created=False, *args, **kwargs):
@@ -0,0 +1,10 @@
+from rest_framework.pagination import CursorPagination
+
+
+class PrimaryKeyCursorPagination(CursorPagination):
+    """ Keyset pagination on the primary key. Pages are fetched with
+        "pk > cursor LIMIT page_size", so the cost of a page doesn't grow
+        with its position and no COUNT(*) is needed.
+    """
+    ordering = 'pk'
+    page_size = 100
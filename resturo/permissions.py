@@ -16,5 +16,9 @@ class IsStaffOrTargetUser(permissions.BasePermission):
 class OrganizationPermission(permissions.BasePermission):
 
     def has_permission(self, request, view):
-        return modelresolver('Membership').objects.filter(
-            organization=view.get_object(), user=request.user).exists()
+        """ check membership of the organization in the url, without
+            fetching the organization itself """
+        organization_id = view.kwargs[view.lookup_url_kwarg or
+                                      view.lookup_field]
+        return modelresolver.models.Membership.is_member(
+            request.user, organization_id)
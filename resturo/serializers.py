@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework_jwt.settings import api_settings
 
+from .instrumentation import measure
 from .models import EmailVerification, modelresolver
 
 
@@ -18,6 +19,8 @@ class UserSerializer(serializers.ModelSerializer):
     verified = serializers.SerializerMethodField()
 
     def get_verified(self, obj):
+        """ views select_related('verification'), a missing verification
+            raises DoesNotExist without a query """
         try:
             return obj.verification.verified
         except EmailVerification.DoesNotExist:
@@ -38,9 +41,11 @@ class UserCreateSerializer(serializers.ModelSerializer):
             email=validated_data['email'],
             username=validated_data['username'],
             first_name=validated_data['first_name'],
-            last_name=validated_data['last_name']
+            last_name=validated_data['last_name'],
+            is_active=True
         )
-        user.set_password(validated_data['password'])
+        with measure('password.hash'):
+            user.set_password(validated_data['password'])
         user.save()
         #  XXX should be jwt / token agnostic!
 
@@ -58,7 +63,10 @@ class OrganizationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = modelresolver('Organization')
-        fields = ("id", "name")
+        fields = ("id", "name", "role")
+
+    # only present when annotated on the organization (OrganizationList)
+    role = serializers.IntegerField(read_only=True)
 
 
 class PasswordResetSerializer(serializers.Serializer):
@@ -76,6 +84,13 @@ class InviteSerializer(serializers.Serializer):
     role = serializers.IntegerField()
 
 
+class BulkInviteSerializer(serializers.Serializer):
+    handles = serializers.ListField(child=serializers.CharField(),
+                                    allow_empty=False)
+    strict = serializers.BooleanField()
+    role = serializers.IntegerField()
+
+
 class JoinSerializer(serializers.Serializer):
     JOIN_ACCEPT = 1
     JOIN_REJECT = 2
@@ -1,7 +1,25 @@
+import datetime
+import functools
+import json
+import threading
+
+from contextlib import contextmanager
+
 from django.dispatch import Signal
 from django.dispatch import receiver
 
+from django.apps import apps
 from django.conf import settings
+from django.contrib.auth.tokens import default_token_generator
+from django.db import models, transaction
+from django.utils import timezone
+
+from .instrumentation import get_sinks, measure
+from .mail import mail_batch, queue_mail, render_mail
+from .models import SignalEvent
+from .tokens import verification_token
+
+_local = threading.local()
 
 user_rest_created = Signal(providing_args=["user"])
 user_rest_emailchange = Signal(providing_args=["user"])
@@ -13,22 +31,230 @@ user_email_verified = Signal(providing_args=["user"])
 user_existing_invite = Signal(providing_args=["Invite"])
 user_email_invite = Signal(providing_args=["Invite"])
 
+SIGNALS = {
+    'user_rest_created': user_rest_created,
+    'user_rest_emailchange': user_rest_emailchange,
+    'user_password_reset': user_password_reset,
+    'user_password_confirm': user_password_confirm,
+    'user_email_verified': user_email_verified,
+    'user_existing_invite': user_existing_invite,
+    'user_email_invite': user_email_invite,
+}
+
+
+def serialize(value):
+    if isinstance(value, models.Model):
+        if value.pk is None:
+            # unsaved instances, e.g. signed invites, are stored by value
+            return {'model': value._meta.label,
+                    'fields': dict((f.attname, f.value_from_object(value))
+                                   for f in value._meta.concrete_fields)}
+        return {'model': value._meta.label, 'pk': value.pk}
+    return value
+
+
+def deserialize(value):
+    if isinstance(value, dict) and set(value) == {'model', 'pk'}:
+        return apps.get_model(value['model'])._default_manager.get(
+            pk=value['pk'])
+    if isinstance(value, dict) and set(value) == {'model', 'fields'}:
+        return apps.get_model(value['model'])(**value['fields'])
+    return value
+
+
+def signal_name(signal):
+    return next(name for name, s in SIGNALS.items() if s is signal)
+
+
+def send_robust(signal, sender, **kwargs):
+    """ signal.send_robust, measured as signal.<signal name> if metrics
+        are enabled """
+    if not get_sinks():
+        return signal.send_robust(sender=sender, **kwargs)
+
+    with measure('signal.' + signal_name(signal)):
+        return signal.send_robust(sender=sender, **kwargs)
+
+
+def measured_receiver(func):
+    """ Measure func, a receiver of a resturo signal, as
+        signal.<signal name>.<module>.<receiver> if metrics are enabled.
+        The resturo receivers are measured, decorate your own below
+        @receiver to measure them as well:
+
+            @receiver(user_rest_created)
+            @measured_receiver
+            def welcome(sender, user, **kwargs):
+                ...
+    """
+    @functools.wraps(func)
+    def wrapper(signal, sender, **kwargs):
+        with measure('signal.{0}.{1}.{2}'.format(
+                signal_name(signal), func.__module__, func.__qualname__)):
+            return func(signal=signal, sender=sender, **kwargs)
+    return wrapper
+
+
+def send(signal, sender, **kwargs):
+    """ Send one of the resturo signals with send_robust, or, if
+        RESTURO_SIGNAL_OUTBOX is set, store it as a SignalEvent within the
+        current transaction for delivery by resturo_dispatch_signals.
+        Use atomic_signals() to make the event part of the transaction
+        that made the change it reports.
+
+        Within an atomic_signals() block, signals that are sent directly
+        are delivered when the block exits.
+
+        Model instances in sender and kwargs are stored by reference,
+        unsaved instances by value.
+    """
+    if not getattr(settings, "RESTURO_SIGNAL_OUTBOX", False):
+        pending = getattr(_local, 'pending', None)
+        if pending is not None:
+            pending.append((signal, sender, kwargs))
+            return []
+        return send_robust(signal, sender, **kwargs)
+
+    make_event(signal, sender, kwargs).save()
+    return []
+
+
+def send_bulk(sends):
+    """ send() every (signal, sender, kwargs) in sends, storing them with
+        a single insert if RESTURO_SIGNAL_OUTBOX is set """
+    if not getattr(settings, "RESTURO_SIGNAL_OUTBOX", False):
+        for signal, sender, kwargs in sends:
+            send(signal, sender, **kwargs)
+        return
+
+    SignalEvent.objects.bulk_create(
+        [make_event(signal, sender, kwargs)
+         for signal, sender, kwargs in sends])
+
+
+def make_event(signal, sender, kwargs):
+    """ an unsaved SignalEvent for signal """
+    payload = {'sender': serialize(sender),
+               'kwargs': dict((k, serialize(v)) for k, v in kwargs.items())}
+    return SignalEvent(signal=signal_name(signal),
+                       payload=json.dumps(payload))
+
+
+@contextmanager
+def atomic_signals():
+    """ Run the block in transaction.atomic(). Signals sent in the block
+        are stored in the outbox within that transaction or, without
+        outbox, delivered once the block exits without an exception, so
+        receivers (e.g. sending mail) don't run while the transaction
+        holds its locks. Nested blocks join the outermost block.
+    """
+    if getattr(_local, 'pending', None) is not None:
+        with transaction.atomic():
+            yield
+        return
+
+    _local.pending = []
+    try:
+        with transaction.atomic():
+            yield
+        pending = _local.pending
+    finally:
+        _local.pending = None
+
+    for signal, sender, kwargs in pending:
+        send_robust(signal, sender, **kwargs)
+
+
+def deliver(event):
+    """ send the signal stored in event, raising the first exception
+        a receiver raised """
+    payload = json.loads(event.payload)
+    kwargs = dict((k, deserialize(v))
+                  for k, v in payload['kwargs'].items())
+    responses = send_robust(SIGNALS[event.signal],
+                            deserialize(payload['sender']), **kwargs)
+
+    for _, response in responses:
+        if isinstance(response, Exception):
+            raise response
+
+
+def lock(queryset):
+    """ lock rows, skipping rows locked by other workers where supported """
+    try:
+        return queryset.select_for_update(skip_locked=True)
+    except TypeError:  # Django < 1.11
+        return queryset.select_for_update()
+
+
+def dispatch_outbox(batch_size=100, max_attempts=5):
+    """ Deliver a batch of pending SignalEvents. Failed deliveries are
+        retried with exponential backoff, events that failed max_attempts
+        times are marked failed. Returns the number of events handled.
+    """
+    backoff = getattr(settings, "RESTURO_SIGNAL_OUTBOX_BACKOFF", 30)
+    now = timezone.now()
+
+    def retry(event, error):
+        event.attempts += 1
+        event.failed = event.attempts >= max_attempts
+        event.available = now + datetime.timedelta(
+            seconds=backoff * 2 ** (event.attempts - 1))
+        event.last_error = repr(error)
+        event.save()
+
+    with transaction.atomic():
+        events = list(lock(SignalEvent.objects.filter(
+            failed=False, available__lte=now
+        ).order_by('available', 'pk'))[:batch_size])
+
+        # mails for the whole batch share one connection. If sending them
+        # fails, every delivered event is retried, like a failed delivery
+        delivered = []
+        try:
+            with mail_batch():
+                for event in events:
+                    try:
+                        # a failing receiver must not abort the batch's
+                        # transaction
+                        with transaction.atomic():
+                            deliver(event)
+                    except Exception as e:
+                        retry(event, e)
+                    else:
+                        delivered.append(event)
+        except Exception as e:
+            for event in delivered:
+                retry(event, e)
+            delivered = []
+
+        SignalEvent.objects.filter(
+            pk__in=[event.pk for event in delivered]).delete()
+
+    return len(events)
+
 
 @receiver(user_rest_created, dispatch_uid="resturo.signals.send_welcome_mail")
+@measured_receiver
 def send_welcome_mail(sender, user, **kwargs):
     if getattr(settings, "RESTURO_SEND_WELCOME", False):
-        pass
+        queue_mail(render_mail('welcome', {'user': user}, [user.email]))
 
 
 @receiver(user_rest_emailchange,
           dispatch_uid="resturo.signals.send_email_verification")
+@measured_receiver
 def send_email_verification(sender, user, **kwargs):
     if getattr(settings, "RESTURO_VERIFY_EMAIL", False):
-        pass
+        queue_mail(render_mail('verify_email',
+                               {'user': user,
+                                'token': verification_token(user)},
+                               [user.email]))
 
 
 @receiver(user_email_verified,
           dispatch_uid="resturo.signals.handle_email_verified")
+@measured_receiver
 def handle_email_verified(sender, user, **kwargs):
     if getattr(settings, "RESTURO_VERIFY_EMAIL", False):
         pass
@@ -36,26 +262,40 @@ def handle_email_verified(sender, user, **kwargs):
 
 @receiver(user_password_reset,
           dispatch_uid="resturo.signals.send_password_mail")
+@measured_receiver
 def send_password_mail(sender, user, **kwargs):
     if getattr(settings, "RESTURO_SEND_PASSWORDRESET", False):
-        pass
+        token = '{0}-{1}'.format(user.pk,
+                                 default_token_generator.make_token(user))
+        queue_mail(render_mail('password_reset',
+                               {'user': user, 'token': token},
+                               [user.email]))
 
 
 @receiver(user_password_confirm,
           dispatch_uid="resturo.signals.send_password_confirm_mail")
+@measured_receiver
 def send_password_confirm_mail(sender, user, **kwargs):
     if getattr(settings, "RESTURO_SEND_PASSWORDRESET", False):
-        pass
+        queue_mail(render_mail('password_confirm', {'user': user},
+                               [user.email]))
 
 
 @receiver(user_existing_invite,
           dispatch_uid="resturo.signals.send_invite_user")
-def send_invite_user(sender, user, **kwargs):
+@measured_receiver
+def send_invite_user(sender, invite, **kwargs):
     if getattr(settings, "RESTURO_SEND_INVITE", False):
-        pass
+        queue_mail(render_mail('invite_user',
+                               {'invite': invite, 'organization': sender,
+                                'user': invite.user},
+                               [invite.user.email]))
 
 
 @receiver(user_email_invite, dispatch_uid="resturo.signals.send_invite_email")
-def send_invite_email(sender, user, **kwargs):
+@measured_receiver
+def send_invite_email(sender, invite, **kwargs):
     if getattr(settings, "RESTURO_SEND_INVITE", False):
-        pass
+        queue_mail(render_mail('invite_email',
+                               {'invite': invite, 'organization': sender},
+                               [invite.email]))
@@ -0,0 +1,146 @@
+from unittest import mock
+
+from django.test import TestCase, RequestFactory, override_settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.contrib.auth.tokens import default_token_generator
+from django.core.urlresolvers import reverse
+from django.core.exceptions import PermissionDenied
+
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
+from rest_framework.test import APITestCase
+from rest_framework_jwt.settings import api_settings
+
+from .factories import UserFactory
+from ..authentication import JSONWebTokenAuthentication
+from ..middleware import get_user_jwt
+from .. import authentication
+
+
+def make_token(user):
+    payload = api_settings.JWT_PAYLOAD_HANDLER(user)
+    return api_settings.JWT_ENCODE_HANDLER(payload)
+
+
+class TestJSONWebTokenAuthentication(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = UserFactory.create()
+        self.token = make_token(self.user)
+
+    def test_decode_once(self):
+        """ the middleware and DRF share a single decode and user lookup """
+        req = self.factory.get('/', {},
+                               HTTP_AUTHORIZATION="JWT " + self.token)
+
+        with mock.patch.object(authentication, 'jwt_decode_handler',
+                               wraps=authentication.jwt_decode_handler) \
+                as decode:
+            self.assertEquals(get_user_jwt(req), self.user)
+            with self.assertNumQueries(0):
+                user, token = JSONWebTokenAuthentication().authenticate(
+                    Request(req))
+            self.assertEquals(decode.call_count, 1)
+
+        self.assertEquals(user, self.user)
+        self.assertEquals(req._jwt_payload['user_id'], self.user.pk)
+
+    def test_no_token(self):
+        req = self.factory.get('/', {})
+        self.assertIsNone(
+            JSONWebTokenAuthentication().authenticate(Request(req)))
+
+    def test_invalid_token_remembered(self):
+        req = self.factory.get('/', {},
+                               HTTP_AUTHORIZATION="JWT not-a-valid-token")
+        with self.assertRaises(PermissionDenied):
+            get_user_jwt(req)
+
+        with mock.patch.object(authentication,
+                               'jwt_decode_handler') as decode:
+            with self.assertRaises(AuthenticationFailed):
+                JSONWebTokenAuthentication().authenticate(Request(req))
+            self.assertFalse(decode.called)
+
+
+@override_settings(RESTURO_JWT_USER_CACHE='resturo.cache.TokenUserCache')
+class TestTokenUserCache(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.user = UserFactory.create()
+        self.token = make_token(self.user)
+
+    def authenticate(self):
+        req = self.factory.get('/', {},
+                               HTTP_AUTHORIZATION="JWT " + self.token)
+        return JSONWebTokenAuthentication().authenticate(Request(req))
+
+    def test_cached(self):
+        """ a known token needs no decoding and no user query """
+        self.authenticate()
+        with mock.patch.object(authentication,
+                               'jwt_decode_handler') as decode:
+            with self.assertNumQueries(0):
+                user, token = self.authenticate()
+            self.assertFalse(decode.called)
+        self.assertEquals(user, self.user)
+
+    def test_invalidate_on_save(self):
+        self.authenticate()
+        self.user.first_name = 'changed'
+        self.user.save()
+        with self.assertNumQueries(1):
+            user, token = self.authenticate()
+        self.assertEquals(user.first_name, 'changed')
+
+    def test_invalidate_on_deactivation(self):
+        self.authenticate()
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_invalidate_on_password_reset(self):
+        self.authenticate()
+        token = '{0}-{1}'.format(self.user.pk,
+                                 default_token_generator.make_token(self.user))
+        self.client.post(reverse('resturo_user_reset'),
+                         {'token': token, 'password': 'n3w'})
+        with self.assertNumQueries(1):
+            self.authenticate()
+
+    def test_change_while_loading(self):
+        """ a change between reading the generation and loading the user
+            isn't cached as current """
+        authenticate_credentials = \
+            JSONWebTokenAuthentication.authenticate_credentials
+
+        def load_then_change(auth, payload):
+            user = authenticate_credentials(auth, payload)
+            User.objects.get(pk=self.user.pk).save()
+            return user
+
+        with mock.patch.object(JSONWebTokenAuthentication,
+                               'authenticate_credentials', load_then_change):
+            self.authenticate()
+        with self.assertNumQueries(1):
+            self.authenticate()
+
+    def test_no_password_cached(self):
+        self.user.set_password('secret')
+        self.user.save()
+        self.authenticate()
+        user, token = self.authenticate()
+        with self.assertNumQueries(1):
+            self.assertEquals(user.password, self.user.password)
+
+    def test_expired(self):
+        """ tokens are never cached beyond their expiration """
+        with mock.patch('time.time', return_value=10 ** 10):
+            self.authenticate()
+        with self.assertNumQueries(1):
+            self.authenticate()
@@ -0,0 +1,63 @@
+from unittest import mock
+
+from django.db import connection
+from django.db.backends.base.introspection import FieldInfo
+from django.test import TestCase
+from django.core.management import call_command
+from django.utils.six import StringIO
+
+from .factories import UserFactory
+from ..backfill import backfill_token
+from ..models import EmailVerification
+
+
+class TestBackfillEmailVerification(TestCase):
+
+    def setUp(self):
+        self.users = UserFactory.create_batch(5)
+        self.unverified = self.users[2]
+        EmailVerification.objects.create(user=self.unverified,
+                                         verified=False)
+
+    def test_backfill(self):
+        call_command('resturo_backfill_verification', batch_size=2,
+                     stdout=StringIO())
+
+        self.assertEquals(EmailVerification.objects.count(), 5)
+        self.assertEquals(
+            EmailVerification.objects.filter(verified=True).count(), 4)
+        # existing verifications are left alone
+        self.assertFalse(EmailVerification.objects.get(
+            user=self.unverified).verified)
+
+    def test_resume(self):
+        start = self.users[2].pk
+        out = StringIO()
+        call_command('resturo_backfill_verification', start=start,
+                     verbosity=2, stdout=out)
+
+        self.assertEquals(
+            set(EmailVerification.objects.values_list('user', flat=True)),
+            set(u.pk for u in self.users[2:]))
+        self.assertIn("done, last pk {0}".format(self.users[-1].pk),
+                      out.getvalue())
+
+    def test_batched_queries(self):
+        """ a batch costs a constant number of queries, regardless of the
+            number of users in it """
+        # the token column's state, range, anti-join and insert (within a
+        # savepoint) plus the final empty range
+        with self.assertNumQueries(1 + 3 + 2 + 1):
+            call_command('resturo_backfill_verification', batch_size=5,
+                         stdout=StringIO())
+
+    def test_before_migration(self):
+        """ before 0003 the token column is NOT NULL, backfill '' """
+        token = FieldInfo('token', 'varchar', None, 36, None, None, False)
+        with mock.patch.object(connection.introspection,
+                               'get_table_description',
+                               return_value=[token]):
+            self.assertEquals(backfill_token(EmailVerification), '')
+
+    def test_after_migration(self):
+        self.assertIsNone(backfill_token(EmailVerification))
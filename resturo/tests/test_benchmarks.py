@@ -0,0 +1,247 @@
+""" Benchmarks for the resturo views and middleware.
+
+    Skipped unless RESTURO_BENCHMARK is set:
+
+        RESTURO_BENCHMARK=1 python runtests.py
+
+    Every benchmark fails if it runs more queries than recorded in
+    benchmarks.json. Timings depend on the machine, so they are only
+    compared against a baseline recorded on the same host, kept in the
+    file RESTURO_BENCHMARK_TIMINGS points to: a median exceeding that
+    baseline by more than RESTURO_BENCHMARK_TOLERANCE (a factor, 2.0 by
+    default) fails as well. RESTURO_BENCHMARK=update records new query
+    counts and, if RESTURO_BENCHMARK_TIMINGS is set, new timings instead
+    of comparing.
+"""
+import json
+import os
+import statistics
+import time
+import unittest
+import uuid
+
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from .factories import UserFactory, OrganizationFactory
+from .models import Organization, Membership, Invite
+from ..middleware import SelectOrganizationMiddleware
+from ..models import EmailVerification
+from ..serializers import JoinSerializer
+
+BENCHMARK = os.environ.get('RESTURO_BENCHMARK')
+TOLERANCE = float(os.environ.get('RESTURO_BENCHMARK_TOLERANCE', 2.0))
+BASELINE = os.path.join(os.path.dirname(__file__), 'benchmarks.json')
+TIMINGS = os.environ.get('RESTURO_BENCHMARK_TIMINGS')
+
+USERS = 10000
+MEMBERS = 5000
+INVITES = 2000
+ROUNDS = 20
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+
+@unittest.skipUnless(BENCHMARK, "set RESTURO_BENCHMARK to run benchmarks")
+class TestBenchmarks(APITestCase):
+    """ The first MEMBERS users are members of the large organization,
+        the rest (the outsiders) have pending email verifications and the
+        first INVITES of them an invite to the large organization. The
+        medium organization overlaps both groups. """
+    queries = {}
+    timings = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        Organization.objects.bulk_create(
+            [OrganizationFactory.build(name='org{0}'.format(i))
+             for i in range(3)])
+        cls.large, cls.medium, cls.small = Organization.objects.order_by(
+            'pk')
+
+        UserFactory._meta.model.objects.bulk_create(
+            [UserFactory.build(username='user{0}'.format(i),
+                               email='user{0}@example.org'.format(i))
+             for i in range(USERS)])
+        cls.users = list(UserFactory._meta.model.objects.order_by('pk'))
+        cls.admin = cls.users[0]
+
+        Membership.objects.bulk_create(
+            [Membership(user=user, organization=cls.large, role=1)
+             for user in cls.users[:MEMBERS]] +
+            [Membership(user=user, organization=cls.medium)
+             for user in cls.users[MEMBERS // 2:MEMBERS + MEMBERS // 2]] +
+            [Membership(user=user, organization=cls.small)
+             for user in cls.users[:10] + cls.users[MEMBERS:]])
+
+        cls.outsiders = cls.users[MEMBERS:]
+        Invite.objects.bulk_create(
+            [Invite(user=user, inviter=cls.admin, organization=cls.large,
+                    token=str(uuid.uuid4()))
+             for user in cls.outsiders[:INVITES]])
+        EmailVerification.objects.bulk_create(
+            [EmailVerification(user=user, token=str(uuid.uuid4()))
+             for user in cls.outsiders])
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if BENCHMARK == 'update' and cls.queries:
+            save_baseline(BASELINE, cls.queries)
+            if TIMINGS:
+                save_baseline(TIMINGS, cls.timings)
+
+    def benchmark(self, name, func, rounds=ROUNDS):
+        """ run func (which gets the round number) rounds times after
+            one warm up round and compare the maximum number of queries
+            and, with a baseline for this host, the median time against
+            the baselines """
+        func(rounds)
+
+        timings = []
+        queries = 0
+        for i in range(rounds):
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                func(i)
+                timings.append(time.perf_counter() - start)
+            queries = max(queries, len(context))
+
+        median = statistics.median(timings)
+        self.queries[name] = queries
+        self.timings[name] = median
+        if BENCHMARK == 'update':
+            return
+
+        baseline = load_baseline(BASELINE).get(name)
+        if baseline is None:
+            self.fail("no baseline for {0}, record one with "
+                      "RESTURO_BENCHMARK=update".format(name))
+
+        self.assertLessEqual(
+            queries, baseline,
+            "{0}: {1} queries, baseline {2}".format(name, queries, baseline))
+
+        baseline = load_baseline(TIMINGS).get(name) if TIMINGS else None
+        if baseline is not None:
+            self.assertLessEqual(
+                median, baseline * TOLERANCE,
+                "{0}: median {1:.2f}ms, baseline {2:.2f}ms".format(
+                    name, median * 1000, baseline * 1000))
+
+    def test_middleware_header(self):
+        factory = RequestFactory()
+        middleware = SelectOrganizationMiddleware()
+
+        def select(i):
+            request = factory.get('/', HTTP_ORGANIZATION=self.large.pk)
+            request.user = self.users[i]
+            middleware.process_request(request)
+            self.assertEquals(request.organization, self.large)
+
+        self.benchmark('middleware_header', select)
+
+    def test_middleware_default(self):
+        factory = RequestFactory()
+        middleware = SelectOrganizationMiddleware()
+
+        def select(i):
+            request = factory.get('/')
+            request.user = self.users[MEMBERS // 2 + i]
+            middleware.process_request(request)
+            self.assertEquals(request.organization, self.medium)
+
+        self.benchmark('middleware_default', select)
+
+    def test_user_list(self):
+        self.client.force_authenticate(self.admin)
+
+        def list_users(i):
+            response = self.client.get(reverse('resturo_user_create'))
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        self.benchmark('user_list', list_users)
+
+    def test_user_create(self):
+        def create(i):
+            response = self.client.post(
+                reverse('resturo_user_create'),
+                {"username": "new{0}".format(i),
+                 "email": "new{0}@example.org".format(i),
+                 "password": "secret", "first_name": "New",
+                 "last_name": "User"}, format='json')
+            self.assertEquals(response.status_code,
+                              status.HTTP_201_CREATED)
+
+        self.benchmark('user_create', create, rounds=5)
+
+    def test_organization_list(self):
+        self.client.force_authenticate(self.admin)
+
+        def list_organizations(i):
+            response = self.client.get(reverse('resturo_organization_list'))
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        self.benchmark('organization_list', list_organizations)
+
+    def test_organization_invite(self):
+        self.client.force_authenticate(self.admin)
+        url = reverse('resturo_organization_invite',
+                      kwargs={'pk': self.large.pk})
+
+        def invite(i):
+            response = self.client.post(
+                url, {"handle": self.outsiders[-1 - i].username,
+                      "role": 0, "strict": False}, format='json')
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        self.benchmark('organization_invite', invite)
+
+    def test_organization_join(self):
+        invites = list(Invite.objects.select_related('user')[:ROUNDS + 1])
+
+        def join(i):
+            self.client.force_authenticate(invites[i].user)
+            response = self.client.post(
+                reverse('resturo_organization_join'),
+                {"token": invites[i].token,
+                 "action": JoinSerializer.JOIN_ACCEPT}, format='json')
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        self.benchmark('organization_join', join)
+
+    def test_password_reset(self):
+        def reset(i):
+            response = self.client.get(reverse('resturo_user_reset'),
+                                       {'handle': self.users[i].email})
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        self.benchmark('password_reset', reset)
+
+    def test_email_verification(self):
+        tokens = list(EmailVerification.objects.filter(
+            user__in=self.outsiders[:ROUNDS + 1]
+        ).values_list('token', flat=True))
+
+        def verify(i):
+            response = self.client.get(reverse('resturo_user_verify'),
+                                       {'token': tokens[i]})
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        self.benchmark('email_verification', verify)
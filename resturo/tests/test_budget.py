@@ -0,0 +1,224 @@
+import logging
+
+from unittest import mock
+
+from django.contrib.auth.tokens import default_token_generator
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from .factories import UserFactory, MembershipFactory, InviteFactory
+from .factories import user_with_org
+from .models import Organization
+from ..budget import QueryBudgetExceeded, QueryRecorder
+from ..budget import assert_query_budget, get_query_budget
+from ..models import EmailVerification
+from .. import views
+
+
+class TestQueryRecorder(TestCase):
+
+    def test_nested(self):
+        with QueryRecorder() as outer:
+            list(Organization.objects.all())
+            with QueryRecorder() as inner:
+                list(Organization.objects.all())
+
+        self.assertEquals(len(outer), 2)
+        self.assertEquals(len(inner), 1)
+        self.assertIn('test_budget.py', inner.format())
+
+    def test_capture_inside(self):
+        """ assertNumQueries keeps working while recording """
+        with QueryRecorder() as recorder:
+            with self.assertNumQueries(1):
+                list(Organization.objects.all())
+        self.assertEquals(len(recorder), 1)
+
+    def test_get_query_budget(self):
+        class View(object):
+            query_budget = {'GET': 1}
+
+        self.assertEquals(get_query_budget(View, 'get'), 1)
+        self.assertIsNone(get_query_budget(View, 'POST'))
+        self.assertEquals(
+            get_query_budget(views.UserSelfView.as_view(), 'GET'),
+            views.UserSelfView.query_budget['GET'])
+
+    def test_exceeded(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with assert_query_budget(views.UserSelfView, 'GET'):
+                for i in range(views.UserSelfView.query_budget['GET'] + 1):
+                    list(Organization.objects.all())
+
+
+class TestViewBudgets(APITestCase):
+    """ the views stay within their query budget, with session
+        authentication """
+
+    def setUp(self):
+        self.u, self.o = user_with_org('john', 'acme')
+        # created along with the user if RESTURO_VERIFY_EMAIL is set
+        EmailVerification.objects.update_or_create(
+            user=self.u, defaults={'verified': True})
+        self.client.force_login(self.u)
+
+    def test_user_list(self):
+        with assert_query_budget(views.UserCreateView, 'GET'):
+            response = self.client.get(reverse('resturo_user_create'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_user_create(self):
+        self.client.logout()
+        with assert_query_budget(views.UserCreateView, 'POST'):
+            response = self.client.post(
+                reverse('resturo_user_create'),
+                {"username": "jane", "email": "jane@example.com",
+                 "password": "secret", "first_name": "Jane",
+                 "last_name": "Doe"}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+
+    def test_user_detail(self):
+        url = reverse('resturo_user_detail', kwargs={'pk': self.u.pk})
+        with assert_query_budget(views.UserDetailView, 'GET'):
+            self.client.get(url)
+        with assert_query_budget(views.UserDetailView, 'PATCH'):
+            response = self.client.patch(url, {"email": "j@example.com"},
+                                         format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_user_self(self):
+        with assert_query_budget(views.UserSelfView, 'GET'):
+            response = self.client.get(reverse('resturo_user_self'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_password_reset(self):
+        with assert_query_budget(views.PasswordResetView, 'GET'):
+            self.client.get(reverse('resturo_user_reset'),
+                            {'handle': self.u.email})
+
+    def test_password_reset_confirm(self):
+        token = '{0}-{1}'.format(self.u.pk,
+                                 default_token_generator.make_token(self.u))
+        with assert_query_budget(views.PasswordResetView, 'POST'):
+            response = self.client.post(reverse('resturo_user_reset'),
+                                        {'token': token,
+                                         'password': 'secret'})
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_email_verification(self):
+        v = self.u.verification
+        v.reset()
+        with assert_query_budget(views.EmailVerificationView, 'GET'):
+            response = self.client.get(reverse('resturo_user_verify'),
+                                       {'token': v.token})
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_organization_list(self):
+        with assert_query_budget(views.OrganizationList, 'GET'):
+            response = self.client.get(reverse('resturo_organization_list'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_organization_create(self):
+        with assert_query_budget(views.OrganizationList, 'POST'):
+            response = self.client.post(reverse('resturo_organization_list'),
+                                        {"name": "emca"}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+
+    def test_organization_detail(self):
+        url = reverse('resturo_organization_details',
+                      kwargs={'pk': self.o.pk})
+        with assert_query_budget(views.OrganizationDetail, 'GET'):
+            self.client.get(url)
+        with assert_query_budget(views.OrganizationDetail, 'PATCH'):
+            response = self.client.patch(url, {"name": "emca"},
+                                         format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        InviteFactory.create(organization=self.o)
+        with assert_query_budget(views.OrganizationDetail, 'DELETE'):
+            response = self.client.delete(url)
+        self.assertEquals(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_organization_invite(self):
+        handle = UserFactory.create().username
+        with assert_query_budget(views.OrganizationInvite, 'POST'):
+            response = self.client.post(
+                reverse('resturo_organization_invite',
+                        kwargs={'pk': self.o.pk}),
+                {"handle": handle, "role": 0,
+                 "strict": False}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_organization_bulk_invite(self):
+        handles = [UserFactory.create().username for i in range(10)]
+        with assert_query_budget(views.OrganizationBulkInvite, 'POST'):
+            response = self.client.post(
+                reverse('resturo_organization_bulk_invite',
+                        kwargs={'pk': self.o.pk}),
+                {"handles": handles + ["x@example.com"], "role": 0,
+                 "strict": False}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_organization_join(self):
+        invite = InviteFactory.create(user=self.u)
+        with assert_query_budget(views.OrganizationJoin, 'POST'):
+            response = self.client.post(
+                reverse('resturo_organization_join'),
+                {"token": invite.token}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+
+@override_settings(RESTURO_SIGNAL_OUTBOX=True, RESTURO_VERIFY_EMAIL=True)
+class TestViewBudgetsOutbox(TestViewBudgets):
+    """ and with email verification and the signal outbox, which stores
+        the signals they send """
+
+
+@override_settings(
+    MIDDLEWARE_CLASSES=['resturo.middleware.QueryBudgetMiddleware'])
+class TestQueryBudgetMiddleware(APITestCase):
+
+    def setUp(self):
+        self.m = MembershipFactory.create()
+        self.client.force_authenticate(self.m.user)
+        self.url = reverse('resturo_user_self')
+
+    def test_disabled(self):
+        with self.settings(RESTURO_QUERY_BUDGET=None), \
+                self.modify_budget():
+            response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_within_budget(self):
+        with self.settings(RESTURO_QUERY_BUDGET='raise'):
+            response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_raise(self):
+        with self.settings(RESTURO_QUERY_BUDGET='raise'), \
+                self.modify_budget():
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(self.url)
+
+    def test_log(self):
+        with self.settings(RESTURO_QUERY_BUDGET='log'), \
+                self.modify_budget(), \
+                self.assertLogs('resturo.budget', logging.WARNING) as logs:
+            response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertIn('GET UserSelfView ran', logs.output[0])
+        self.assertIn('views.py', logs.output[0])
+
+    def test_log_sampled(self):
+        with self.settings(RESTURO_QUERY_BUDGET='log',
+                           RESTURO_QUERY_BUDGET_SAMPLE_RATE=0), \
+                self.modify_budget(), \
+                self.assertRaises(AssertionError), \
+                self.assertLogs('resturo.budget', logging.WARNING):
+            self.client.get(self.url)
+
+    def modify_budget(self):
+        return mock.patch.object(views.UserSelfView, 'query_budget',
+                                 {'GET': 0})
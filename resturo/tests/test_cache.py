@@ -0,0 +1,132 @@
+import sys
+import threading
+
+from django.test import TestCase, RequestFactory, override_settings
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+
+from .factories import UserFactory, OrganizationFactory
+from .factories import user_with_org
+from ..cache import LocalLRU, get_membership_cache
+from ..middleware import SelectOrganizationMiddleware
+
+from .models import Membership
+
+
+class TestLocalLRU(TestCase):
+
+    def test_evict_least_recently_used(self):
+        lru = LocalLRU(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertEquals(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEquals(lru.get('c'), 3)
+
+    def test_expire(self):
+        lru = LocalLRU(timeout=-1)
+        lru.set('a', 1)
+        self.assertIsNone(lru.get('a'))
+
+    def test_threads(self):
+        """ concurrent reads of expired and evicted entries don't fail """
+        lru = LocalLRU(maxsize=4, timeout=0)
+        errors = []
+
+        def run():
+            try:
+                for i in range(10000):
+                    lru.set(i % 8, i)
+                    lru.get((i + 1) % 8)
+                    lru.delete((i + 2) % 8)
+            except Exception as e:
+                errors.append(e)
+
+        # switch threads as often as possible
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+
+
+@override_settings(RESTURO_MEMBERSHIP_CACHE='resturo.cache.MembershipCache')
+class TestMembershipCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.john, self.john_org = user_with_org('john', 'acme')
+        self.jane, self.jane_org = user_with_org('jane', 'emac')
+
+    def test_disabled(self):
+        with self.settings(RESTURO_MEMBERSHIP_CACHE=None):
+            self.assertIsNone(get_membership_cache())
+
+    def test_memberships(self):
+        self.assertEquals(get_membership_cache().get(self.john.pk),
+                          {self.john_org.pk: 1})
+
+    def test_warm_lookup(self):
+        get_membership_cache().get(self.john.pk)
+        with self.assertNumQueries(0):
+            self.assertEquals(
+                get_membership_cache().role(self.john.pk, self.john_org.pk),
+                1)
+
+    def test_invalidate_on_save(self):
+        get_membership_cache().get(self.john.pk)
+        Membership.objects.create(user=self.john, organization=self.jane_org,
+                                  role=2)
+        self.assertEquals(get_membership_cache().get(self.john.pk),
+                          {self.john_org.pk: 1, self.jane_org.pk: 2})
+
+    def test_invalidate_on_delete(self):
+        get_membership_cache().get(self.john.pk)
+        Membership.objects.filter(user=self.john).first().delete()
+        self.assertEquals(get_membership_cache().get(self.john.pk), {})
+
+    def test_middleware_header(self):
+        req = self.factory.get('/', {}, HTTP_ORGANIZATION=self.john_org.id)
+        req.user = self.john
+        get_membership_cache().get(self.john.pk)
+        SelectOrganizationMiddleware().process_request(req)
+        with self.assertNumQueries(1):
+            self.assertEquals(req.organization, self.john_org)
+
+    def test_middleware_default_latest(self):
+        neworg = OrganizationFactory.create()
+        Membership.objects.create(organization=neworg, user=self.john)
+
+        req = self.factory.get('/', {})
+        req.user = self.john
+        SelectOrganizationMiddleware().process_request(req)
+        self.assertEquals(req.organization, neworg)
+
+    def test_middleware_not_member(self):
+        req = self.factory.get('/', {}, HTTP_ORGANIZATION=self.john_org.id)
+        req.user = self.jane
+        SelectOrganizationMiddleware().process_request(req)
+        with self.assertRaises(PermissionDenied):
+            bool(req.organization)
+
+    def test_middleware_incorrect_id(self):
+        req = self.factory.get('/', {}, HTTP_ORGANIZATION=1234)
+        req.user = self.john
+        SelectOrganizationMiddleware().process_request(req)
+        self.assertFalse(req.organization)
+
+    def test_middleware_superuser(self):
+        superuser = UserFactory.create(username='superuser',
+                                       is_superuser=True)
+        req = self.factory.get('/', {}, HTTP_ORGANIZATION=self.john_org.id)
+        req.user = superuser
+        SelectOrganizationMiddleware().process_request(req)
+        self.assertEquals(req.organization, self.john_org)
@@ -0,0 +1,123 @@
+import logging
+import socket
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase, RequestFactory, override_settings
+from rest_framework import status
+from rest_framework.test import APITestCase
+from mock_django.signals import mock_signal_receiver
+
+from .factories import user_with_org
+from .models import Organization
+from ..instrumentation import LoggingSink, StatsdSink
+from ..instrumentation import get_sinks, measure
+from ..middleware import SelectOrganizationMiddleware
+from ..signals import send, measured_receiver, user_rest_created
+
+
+@override_settings(
+    RESTURO_METRICS_SINKS=['resturo.instrumentation.MemorySink'])
+class TestMeasure(APITestCase):
+
+    def setUp(self):
+        self.sink = get_sinks()[0]
+        self.sink.clear()
+        self.u, self.o = user_with_org('john', 'acme')
+
+    def test_measure(self):
+        with measure('block', queries=True):
+            list(Organization.objects.all())
+
+        self.assertEquals(len(self.sink.values('block.time')), 1)
+        self.assertEquals(len(self.sink.values('block.db_time')), 1)
+        self.assertEquals(self.sink.values('block.queries'), [1])
+
+    def test_disabled(self):
+        with self.settings(RESTURO_METRICS_SINKS=[]):
+            with measure('block', queries=True):
+                pass
+        self.assertEquals(self.sink.metrics, [])
+
+    def test_view(self):
+        self.client.force_authenticate(self.u)
+        response = self.client.get(reverse('resturo_user_self'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        self.assertEquals(len(self.sink.values('view.UserSelfView.GET.time')),
+                          1)
+        self.assertEquals(self.sink.values('view.UserSelfView.GET.queries'),
+                          [1])
+
+    def test_middleware(self):
+        req = RequestFactory().get('/')
+        req.user = self.u
+        SelectOrganizationMiddleware().process_request(req)
+        self.assertEquals(self.sink.metrics, [])
+
+        self.assertEquals(req.organization, self.o)
+        name = 'middleware.SelectOrganizationMiddleware.queries'
+        self.assertEquals(self.sink.values(name), [1])
+
+    def test_signal(self):
+        with mock_signal_receiver(user_rest_created) as receiver:
+            receiver.side_effect = ValueError
+            responses = send(user_rest_created, sender=None, user=self.u)
+
+        self.assertIsInstance(dict(responses)[receiver], ValueError)
+        self.assertEquals(
+            len(self.sink.values('signal.user_rest_created.time')), 1)
+
+    def test_signal_receivers(self):
+        """ the resturo receivers are measured individually """
+        send(user_rest_created, sender=None, user=self.u)
+
+        self.assertEquals(len(self.sink.values(
+            'signal.user_rest_created.resturo.signals.send_welcome_mail.time'
+        )), 1)
+
+    def test_measured_receiver(self):
+        @measured_receiver
+        def welcome(sender, user, **kwargs):
+            return user
+
+        user_rest_created.connect(welcome)
+        self.addCleanup(user_rest_created.disconnect, welcome)
+
+        responses = send(user_rest_created, sender=None, user=self.u)
+        self.assertEquals(dict(responses)[welcome], self.u)
+        self.assertEquals(len(self.sink.values(
+            'signal.user_rest_created.{0}.{1}.time'.format(
+                __name__, welcome.__qualname__))), 1)
+
+    def test_password_hash(self):
+        response = self.client.post(
+            reverse('resturo_user_create'),
+            {"username": "jane", "email": "jane@example.com",
+             "password": "secret", "first_name": "Jane",
+             "last_name": "Doe"}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(len(self.sink.values('password.hash.time')), 1)
+
+
+class TestSinks(TestCase):
+
+    def test_logging(self):
+        with self.assertLogs('resturo.metrics', logging.INFO) as logs:
+            LoggingSink().timing('view.time', 1.5)
+            LoggingSink().count('view.queries', 3)
+        self.assertEquals(logs.output,
+                          ['INFO:resturo.metrics:view.time 1.500ms',
+                           'INFO:resturo.metrics:view.queries 3'])
+
+    def test_statsd(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+
+        sink = StatsdSink(host='127.0.0.1', port=listener.getsockname()[1])
+        sink.timing('view.time', 1.5)
+        sink.count('view.queries', 3)
+
+        self.assertEquals(listener.recv(512), b'resturo.view.time:1.500|ms')
+        self.assertEquals(listener.recv(512), b'resturo.view.queries:3|c')
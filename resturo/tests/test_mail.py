@@ -0,0 +1,141 @@
+import logging
+import smtplib
+
+from unittest import mock
+
+from django.core import mail as django_mail
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .factories import UserFactory, InviteFactory
+from .. import mail
+from ..mail import mail_batch, queue_mail, render_mail
+from ..models import EmailVerification, SignalEvent
+from ..signals import send, dispatch_outbox
+from ..signals import user_rest_created, user_password_reset
+from ..signals import user_rest_emailchange, user_email_invite
+
+
+class TestRenderMail(TestCase):
+
+    def setUp(self):
+        mail._templates.clear()
+
+    def test_render(self):
+        u = UserFactory.create(first_name="John & Jane")
+        message = render_mail('welcome', {'user': u}, [u.email])
+
+        self.assertEquals(message.subject, "Welcome John & Jane")
+        self.assertIn(u.username, message.body)
+        self.assertEquals(message.to, [u.email])
+
+    def test_template_cache(self):
+        """ templates are compiled once per name and language """
+        u = UserFactory.create()
+        with mock.patch.object(mail.loader, 'select_template',
+                               wraps=mail.loader.select_template) as select:
+            for i in range(3):
+                render_mail('welcome', {'user': u}, [u.email])
+            self.assertEquals(select.call_count, 2)
+
+            render_mail('welcome', {'user': u}, [u.email], language='nl')
+            self.assertEquals(select.call_count, 4)
+
+
+class TestMailBatch(TestCase):
+
+    def message(self, to):
+        return render_mail('password_confirm',
+                           {'user': UserFactory.create()}, [to])
+
+    def test_unbatched(self):
+        queue_mail(self.message('a@example.com'))
+        self.assertEquals(len(django_mail.outbox), 1)
+
+    def test_single_connection(self):
+        with mock.patch.object(mail, 'get_connection',
+                               wraps=mail.get_connection) as connection:
+            with mail_batch():
+                for i in range(10):
+                    queue_mail(self.message('{0}@example.com'.format(i)))
+                with mail_batch():
+                    queue_mail(self.message('nested@example.com'))
+                self.assertEquals(len(django_mail.outbox), 0)
+
+            self.assertEquals(connection.call_count, 1)
+        self.assertEquals(len(django_mail.outbox), 11)
+
+    def test_exception(self):
+        """ nothing is sent if the block fails """
+        with self.assertRaises(ValueError):
+            with mail_batch():
+                queue_mail(self.message('a@example.com'))
+                raise ValueError()
+        self.assertEquals(len(django_mail.outbox), 0)
+
+    def test_fail_silently(self):
+        with mock.patch.object(mail, 'send_messages',
+                               side_effect=smtplib.SMTPException):
+            with self.assertRaises(smtplib.SMTPException):
+                with mail_batch():
+                    queue_mail(self.message('a@example.com'))
+
+            with self.assertLogs('resturo.mail', logging.ERROR):
+                with mail_batch(fail_silently=True):
+                    queue_mail(self.message('a@example.com'))
+
+
+@override_settings(RESTURO_SEND_WELCOME=True,
+                   RESTURO_SEND_PASSWORDRESET=True,
+                   RESTURO_SEND_INVITE=True,
+                   RESTURO_VERIFY_EMAIL=True)
+class TestReceivers(TestCase):
+
+    def setUp(self):
+        self.u = UserFactory.create()
+
+    def test_welcome(self):
+        send(user_rest_created, sender=None, user=self.u)
+        self.assertEquals(django_mail.outbox[0].to, [self.u.email])
+
+    def test_password_reset(self):
+        send(user_password_reset, sender=None, user=self.u)
+        self.assertIn('{0}-'.format(self.u.pk), django_mail.outbox[0].body)
+
+    def test_verify_email(self):
+        send(user_rest_emailchange, sender=None, user=self.u)
+        self.assertIn(EmailVerification.objects.get(user=self.u).token,
+                      django_mail.outbox[0].body)
+
+    def test_invite_email(self):
+        invite = InviteFactory.create(user=None, email="new@example.com")
+        send(user_email_invite, sender=invite.organization, invite=invite)
+        self.assertEquals(django_mail.outbox[0].to, ["new@example.com"])
+        self.assertIn(invite.token, django_mail.outbox[0].body)
+
+    def test_outbox_batch(self):
+        """ mails for an outbox batch share one connection """
+        with self.settings(RESTURO_SIGNAL_OUTBOX=True):
+            for i in range(5):
+                send(user_rest_created, sender=None, user=self.u)
+
+        with mock.patch.object(mail, 'get_connection',
+                               wraps=mail.get_connection) as connection:
+            dispatch_outbox()
+            self.assertEquals(connection.call_count, 1)
+        self.assertEquals(len(django_mail.outbox), 5)
+
+    def test_outbox_batch_failure(self):
+        """ if the batch's mail can't be sent its events are retried """
+        with self.settings(RESTURO_SIGNAL_OUTBOX=True):
+            for i in range(2):
+                send(user_rest_created, sender=None, user=self.u)
+
+        with mock.patch.object(mail, 'send_messages',
+                               side_effect=smtplib.SMTPException("down")):
+            self.assertEquals(dispatch_outbox(), 2)
+
+        for event in SignalEvent.objects.all():
+            self.assertEquals(event.attempts, 1)
+            self.assertGreater(event.available, timezone.now())
+            self.assertIn("down", event.last_error)
@@ -58,7 +58,7 @@ class TestSelectOrganizationMiddleware(TestCase):
         req.user = self.john
         mw = SelectOrganizationMiddleware()
         mw.process_request(req)
-        self.assertRaises(AttributeError, lambda: req.organization)
+        self.assertFalse(req.organization)
 
     def test_simple(self):
         """ most trivial working case """
@@ -73,8 +73,9 @@ class TestSelectOrganizationMiddleware(TestCase):
         req = self.factory.get('/', {}, HTTP_ORGANIZATION=self.john_org.id)
         req.user = self.jane
         mw = SelectOrganizationMiddleware()
+        mw.process_request(req)
         with self.assertRaises(PermissionDenied):
-            mw.process_request(req)
+            bool(req.organization)
 
     def test_superuser_access(self):
         """ superuser can do anything """
@@ -89,5 +90,65 @@ class TestSelectOrganizationMiddleware(TestCase):
                                HTTP_ORGANIZATION=self.john_org.id,
                                HTTP_AUTHORIZATION="JWT not-a-valid-token")
         mw = SelectOrganizationMiddleware()
+        mw.process_request(req)
         with self.assertRaises(PermissionDenied):
+            bool(req.organization)
+
+    def test_malformed_header(self):
+        """ a JWT header without a token, or with spaces in it, is
+            rejected like an invalid token """
+        mw = SelectOrganizationMiddleware()
+        for header in ("JWT", "JWT a b"):
+            req = self.factory.get('/', {}, HTTP_AUTHORIZATION=header)
+            mw.process_request(req)
+            with self.assertRaises(PermissionDenied):
+                bool(req.organization)
+
+    def test_malformed_header_eager_path(self):
+        mw = SelectOrganizationMiddleware()
+        with self.settings(RESTURO_ORGANIZATION_EAGER_PATHS=['/api/']):
+            for header in ("JWT", "JWT a b"):
+                req = self.factory.get('/api/', {},
+                                       HTTP_AUTHORIZATION=header)
+                with self.assertRaises(PermissionDenied):
+                    mw.process_request(req)
+
+    def test_lazy(self):
+        """ the organization is only resolved when used """
+        req = self.factory.get('/', {}, HTTP_ORGANIZATION=self.john_org.id)
+        req.user = self.john
+        mw = SelectOrganizationMiddleware()
+        with self.assertNumQueries(0):
             mw.process_request(req)
+        with self.assertNumQueries(2):
+            self.assertEquals(req.organization, self.john_org)
+        with self.assertNumQueries(0):
+            self.assertEquals(req.organization.name, 'acme')
+
+    def test_eager_path(self):
+        """ paths configured as eager are checked in the middleware """
+        req = self.factory.get('/api/', {},
+                               HTTP_ORGANIZATION=self.john_org.id)
+        req.user = self.jane
+        mw = SelectOrganizationMiddleware()
+        with self.settings(RESTURO_ORGANIZATION_EAGER_PATHS=['/api/']):
+            with self.assertRaises(PermissionDenied):
+                mw.process_request(req)
+
+    def test_eager_path_no_organization(self):
+        req = self.factory.get('/api/', {}, HTTP_ORGANIZATION=1234)
+        req.user = self.john
+        mw = SelectOrganizationMiddleware()
+        with self.settings(RESTURO_ORGANIZATION_EAGER_PATHS=['/api/']):
+            mw.process_request(req)
+        self.assertRaises(AttributeError, lambda: req.organization)
+
+    def test_eager_path_no_match(self):
+        req = self.factory.get('/other/', {},
+                               HTTP_ORGANIZATION=self.john_org.id)
+        req.user = self.jane
+        mw = SelectOrganizationMiddleware()
+        with self.settings(RESTURO_ORGANIZATION_EAGER_PATHS=['/api/']):
+            mw.process_request(req)
+        with self.assertRaises(PermissionDenied):
+            bool(req.organization)
@@ -1,7 +1,14 @@
+import json
+import logging
+import smtplib
 import unittest
 import uuid
 
-from django.test import TestCase
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection
 from django.contrib.auth.models import User
 
 from django.core.urlresolvers import reverse
@@ -16,10 +23,14 @@ from .factories import UserFactory, MembershipFactory, InviteFactory
 from .models import Organization, Invite, Membership
 from resturo.serializers import JoinSerializer
 
-from resturo.models import EmailVerification
+from resturo.models import EmailVerification, RevokedInvite, SignalEvent
+from resturo.models import modelresolver
+from resturo.tokens import make_verification_token, revoke_invite_token
+from resturo.views import UserDetailView
 
 from resturo.signals import user_password_reset, user_rest_created
 from resturo.signals import user_existing_invite, user_email_invite
+from resturo.signals import user_rest_emailchange
 
 
 class OrganizationFactory(OrganizationFactoryBase):
@@ -35,6 +46,41 @@ class TestModels(unittest.TestCase):
         o.save()
 
 
+class TestMembership(TestCase):
+
+    def setUp(self):
+        self.m = MembershipFactory.create()
+
+    def test_is_member(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(Membership.is_member(self.m.user,
+                                                 self.m.organization))
+        self.assertTrue(Membership.is_member(self.m.user.pk,
+                                             str(self.m.organization.pk)))
+
+    def test_not_member(self):
+        self.assertFalse(Membership.is_member(UserFactory.create(),
+                                              self.m.organization))
+        self.assertFalse(Membership.is_member(self.m.user,
+                                              OrganizationFactory.create()))
+
+    def test_unique(self):
+        """ a user can be member of an organization only once """
+        with self.assertRaises(IntegrityError):
+            Membership.objects.create(user=self.m.user,
+                                      organization=self.m.organization)
+
+    def test_cached(self):
+        cache.clear()
+        with self.settings(
+                RESTURO_MEMBERSHIP_CACHE='resturo.cache.MembershipCache'):
+            Membership.is_member(self.m.user, self.m.organization)
+            with self.assertNumQueries(0):
+                self.assertTrue(Membership.is_member(self.m.user,
+                                                     self.m.organization))
+                self.assertFalse(Membership.is_member(self.m.user, 0))
+
+
 class TestUserCreation(APITestCase):
 
     def test_signal_fired_create_success(self):
@@ -48,6 +94,168 @@ class TestUserCreation(APITestCase):
                               'password': 'g3h31m'})
             self.assertEqual(receiver.call_count, 1)
 
+    def test_signal_after_transaction(self):
+        """ receivers don't run within the transaction """
+        savepoints = len(connection.savepoint_ids)
+        received = []
+
+        with mock_signal_receiver(user_rest_created) as receiver:
+            receiver.side_effect = (
+                lambda **kwargs: received.append(
+                    len(connection.savepoint_ids)))
+            response = self.client.post(reverse('resturo_user_create'),
+                                        {'username': 'john.doe',
+                                         'first_name': 'john',
+                                         'last_name': 'Doe',
+                                         'email': 'john.doe@example.com',
+                                         'password': 'g3h31m'})
+            self.assertEqual(receiver.call_count, 1)
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(received, [savepoints])
+
+    @override_settings(RESTURO_VERIFY_EMAIL=True)
+    def test_single_write(self):
+        """ the user and its verification are inserted once each """
+        # username validation, the transaction, user and verification
+        with self.assertNumQueries(1 + 2 + 2):
+            response = self.client.post(reverse('resturo_user_create'),
+                                        {'username': 'john.doe',
+                                         'first_name': 'john',
+                                         'last_name': 'Doe',
+                                         'email': 'john.doe@example.com',
+                                         'password': 'g3h31m'})
+
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        u = User.objects.get(username='john.doe')
+        self.assertTrue(u.is_active)
+        self.assertFalse(u.verification.verified)
+
+
+class TestUserList(APITestCase):
+
+    def setUp(self):
+        self.superuser = UserFactory.create(username="superuser",
+                                            is_superuser=True)
+        User.objects.bulk_create(
+            [UserFactory.build(username="user{0}".format(i))
+             for i in range(1000)])
+        EmailVerification.objects.bulk_create(
+            [EmailVerification(user=u, verified=False)
+             for u in User.objects.all()[:500]])
+        self.client.force_login(self.superuser)
+
+    def test_list_query_count(self):
+        """ the verification is fetched along with the users """
+        # session, user and the listing itself
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('resturo_user_create'))
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(len(response.data['results']), 100)
+        self.assertIsNone(response.data['previous'])
+
+    def test_list_cursor(self):
+        """ following the cursor visits every user once """
+        seen = []
+        url = reverse('resturo_user_create')
+        while url:
+            response = self.client.get(url)
+            seen.extend(u['id'] for u in response.data['results'])
+            url = response.data['next']
+
+        self.assertEquals(len(seen), 1001)
+        self.assertEquals(seen, sorted(seen))
+
+    def test_export_ndjson(self):
+        # session, user and a single streaming select
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('resturo_user_create'),
+                                       {'export': 'ndjson'})
+            lines = b''.join(response.streaming_content).splitlines()
+
+        self.assertEquals(response['Content-Type'], 'application/x-ndjson')
+        self.assertEquals(len(lines), 1001)
+        users = [json.loads(line.decode('utf8')) for line in lines]
+        self.assertEquals(len([u for u in users if not u['verified']]), 500)
+
+    def test_export_ndjson_not_superuser(self):
+        """ the export is limited by the same queryset as the listing """
+        self.client.force_login(User.objects.get(username="user1"))
+        response = self.client.get(reverse('resturo_user_create'),
+                                   {'export': 'ndjson'})
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEquals(len(lines), 1)
+
+    def test_detail_query_count(self):
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                reverse('resturo_user_detail',
+                        kwargs={'pk': self.superuser.pk}))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+
+@override_settings(RESTURO_VERIFY_EMAIL=True)
+class TestUserUpdate(APITestCase):
+
+    def setUp(self):
+        self.u = UserFactory.create(email="old@example.com")
+        self.client.force_login(self.u)
+        self.url = reverse('resturo_user_detail', kwargs={'pk': self.u.pk})
+
+    def test_email_change(self):
+        token = self.u.verification.token
+
+        with mock_signal_receiver(user_rest_emailchange) as receiver:
+            # session, user, the user to update with its verification and
+            # updates of the user and the verification in a transaction (a
+            # savepoint within the test)
+            with self.assertNumQueries(5 + 2):
+                response = self.client.patch(self.url,
+                                             {'email': 'new@example.com'})
+            self.assertEqual(receiver.call_count, 1)
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        v = EmailVerification.objects.get(user=self.u)
+        self.assertEquals(v.previous, "old@example.com")
+        self.assertFalse(v.verified)
+        self.assertNotEquals(v.token, token)
+
+    def test_no_email_change(self):
+        with mock_signal_receiver(user_rest_emailchange) as receiver:
+            with self.assertNumQueries(4 + 2):
+                self.client.patch(self.url, {'email': 'OLD@example.com ',
+                                             'first_name': 'changed'})
+            self.assertEqual(receiver.call_count, 0)
+
+    def test_handle_email_change(self):
+        """ handle_email_change gets the user before and after the
+            update """
+        with mock.patch.object(UserDetailView, 'handle_email_change') as h:
+            self.client.patch(self.url, {'email': 'new@example.com'})
+
+        before, after = h.call_args[0]
+        self.assertEquals(before.email, "old@example.com")
+        self.assertEquals(before.pk, self.u.pk)
+        self.assertEquals(after.email, "new@example.com")
+
+    def test_atomic(self):
+        """ the update is rolled back if the verification can't be
+            reset """
+        with mock.patch.object(EmailVerification, 'reset',
+                               side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.client.patch(self.url, {'email': 'new@example.com'})
+        self.assertEquals(User.objects.get(pk=self.u.pk).email,
+                          "old@example.com")
+
+    def test_missing_verification(self):
+        EmailVerification.objects.filter(user=self.u).delete()
+
+        self.client.patch(self.url, {'email': 'new@example.com'})
+        self.assertEquals(
+            EmailVerification.objects.get(user=self.u).previous,
+            "old@example.com")
+
 
 class TestPasswordReset(APITestCase):
 
@@ -73,6 +281,24 @@ class TestEmailVerify(APITestCase):
         v = EmailVerification.objects.get(pk=v.id)
         self.assertTrue(v.verified)
 
+    def test_succeed_case_insensitive(self):
+        u = UserFactory()
+        v = EmailVerification(user=u)
+        v.reset()
+
+        response = self.client.get(reverse('resturo_user_verify'),
+                                   {'token': v.token.upper()})
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(EmailVerification.objects.get(pk=v.id).verified)
+
+    def test_no_token_no_collision(self):
+        """ verifications without a token don't collide in the unique
+            index """
+        EmailVerification.objects.create(user=UserFactory(), verified=True)
+        EmailVerification.objects.create(user=UserFactory(), verified=True)
+        self.assertEquals(
+            EmailVerification.objects.filter(token=None).count(), 2)
+
     def test_no_verify(self):
         u = UserFactory()
 
@@ -105,6 +331,74 @@ class TestEmailVerify(APITestCase):
         self.assertFalse(v.verified)
 
 
+@override_settings(RESTURO_VERIFY_EMAIL_STATELESS=True)
+class TestEmailVerifyStateless(APITestCase):
+
+    def setUp(self):
+        self.u = UserFactory(email="john@example.com")
+        self.v = EmailVerification(user=self.u)
+        self.v.reset()
+
+    def test_reset_stores_no_token(self):
+        self.assertIsNone(EmailVerification.objects.get(pk=self.v.id).token)
+
+    def test_succeed(self):
+        token = make_verification_token(self.u)
+
+        # the user and the update, in a transaction (a savepoint within the
+        # test)
+        with self.assertNumQueries(2 + 2):
+            response = self.client.get(reverse('resturo_user_verify'),
+                                       {'token': token})
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(EmailVerification.objects.get(pk=self.v.id).verified)
+
+    def test_tampered(self):
+        token = make_verification_token(self.u)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('resturo_user_verify'),
+                                       {'token': token.upper()})
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(EmailVerification.objects.get(pk=self.v.id).verified)
+
+    def test_email_changed(self):
+        token = make_verification_token(self.u)
+        User.objects.filter(pk=self.u.pk).update(email="jane@example.com")
+
+        response = self.client.get(reverse('resturo_user_verify'),
+                                   {'token': token})
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(EmailVerification.objects.get(pk=self.v.id).verified)
+
+    def test_expired(self):
+        token = make_verification_token(self.u)
+
+        with self.settings(RESTURO_VERIFY_EMAIL_MAX_AGE=-1):
+            response = self.client.get(reverse('resturo_user_verify'),
+                                       {'token': token})
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(EmailVerification.objects.get(pk=self.v.id).verified)
+
+    def test_stored_token(self):
+        """ tokens sent before the setting was enabled keep working """
+        with self.settings(RESTURO_VERIFY_EMAIL_STATELESS=False):
+            self.v.reset()
+        response = self.client.get(reverse('resturo_user_verify'),
+                                   {'token': self.v.token})
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(EmailVerification.objects.get(pk=self.v.id).verified)
+
+    def test_signed_token_disabled(self):
+        """ and so do signed tokens after it was disabled """
+        token = make_verification_token(self.u)
+        with self.settings(RESTURO_VERIFY_EMAIL_STATELESS=False):
+            response = self.client.get(reverse('resturo_user_verify'),
+                                       {'token': token})
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(EmailVerification.objects.get(pk=self.v.id).verified)
+
+
 class TestInviteModel(TestCase):
 
     def test_token_generation(self):
@@ -126,6 +420,60 @@ class TestInviteModel(TestCase):
         self.assertEqual(token, i.token)
 
 
+class TestOrganizationList(APITestCase):
+
+    def setUp(self):
+        self.u = UserFactory.create()
+        self.member = MembershipFactory.create(user=self.u, role=1)
+        self.admin = MembershipFactory.create(user=self.u, role=2)
+        # another member in the same organization
+        MembershipFactory.create(organization=self.admin.organization,
+                                 role=3)
+        self.other = OrganizationFactory.create()
+        self.client.force_login(self.u)
+
+    def test_roles(self):
+        # session, user and the listing itself
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('resturo_organization_list'))
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(
+            [(o['id'], o['role']) for o in response.data['results']],
+            [(self.member.organization.pk, 1),
+             (self.admin.organization.pk, 2)])
+
+    def test_superuser(self):
+        """ superusers see all organizations, with their role if they're
+            a member """
+        self.u.is_superuser = True
+        self.u.save()
+
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('resturo_organization_list'))
+
+        self.assertEquals(
+            [(o['id'], o['role']) for o in response.data['results']],
+            [(self.member.organization.pk, 1),
+             (self.admin.organization.pk, 2),
+             (self.other.pk, None)])
+
+    def test_paginated(self):
+        for i in range(101):
+            MembershipFactory.create(user=self.u)
+
+        response = self.client.get(reverse('resturo_organization_list'))
+        self.assertEquals(len(response.data['results']), 100)
+        response = self.client.get(response.data['next'])
+        self.assertEquals(len(response.data['results']), 3)
+
+    def test_detail_no_role(self):
+        response = self.client.get(
+            reverse('resturo_organization_details',
+                    kwargs={'pk': self.other.pk}))
+        self.assertNotIn('role', response.data)
+
+
 class TestCreateInvite(APITestCase):
     # for now: invites only for admin
     # add inviter to invite?
@@ -209,6 +557,26 @@ class TestCreateInvite(APITestCase):
                               "strict": False})
             self.assertEqual(receiver.call_count, 1)
 
+    def test_query_count(self):
+        """ the organization is fetched only once """
+        # session, user, membership, organization, handle lookup and the
+        # invite itself (in a transaction, a savepoint within the test)
+        with self.assertNumQueries(6 + 2):
+            self.client.post(reverse('resturo_organization_invite',
+                                     kwargs={'pk': self.o.pk}),
+                             {"handle": "test@example.com",
+                              "role": 2,
+                              "strict": False})
+
+    def test_missing_organization(self):
+        response = self.client.post(reverse('resturo_organization_invite',
+                                            kwargs={'pk': 1234}),
+                                    {"handle": "test@example.com",
+                                     "role": 2,
+                                     "strict": False})
+
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_must_be_member_to_invite(self):
         """ You cannot invite someone into an organization your not member
             yourself of """
@@ -222,6 +590,109 @@ class TestCreateInvite(APITestCase):
         self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
 
 
+class TestBulkInvite(APITestCase):
+
+    def setUp(self):
+        self.m = MembershipFactory.create()
+        self.o = self.m.organization
+        self.client.force_login(self.m.user)
+        self.url = reverse('resturo_organization_bulk_invite',
+                           kwargs={'pk': self.o.pk})
+
+    def invite(self, handles):
+        return self.client.post(self.url, {"handles": handles,
+                                           "role": 2,
+                                           "strict": False}, format='json')
+
+    def test_results(self):
+        UserFactory.create(username="existing", email="existing@example.com")
+        MembershipFactory.create(user__username="member", organization=self.o)
+
+        response = self.invite(["existing", "member", "new@example.com",
+                                "nobody", "Existing@Example.com"])
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(
+            [r['result'] for r in response.data['results']],
+            ["invited", "member", "invited", "invalid", "duplicate"])
+        self.assertEquals(Invite.objects.count(), 2)
+        self.assertEquals(Invite.objects.filter(role=2).count(), 2)
+        self.assertEquals(len(set(Invite.objects.values_list('token',
+                                                             flat=True))), 2)
+
+    def test_query_count(self):
+        """ the number of queries doesn't depend on the number of
+            handles """
+        UserFactory.create_batch(20)
+        handles = list(User.objects.values_list('username', flat=True))
+        handles += ["new{0}@example.com".format(i) for i in range(20)]
+
+        # session, user, membership, organization, users, members, insert,
+        # and fetching the inserted invites, in a transaction (a savepoint
+        # within the test)
+        with self.assertNumQueries(8 + 2):
+            response = self.invite(handles)
+        self.assertEquals(len(response.data['results']), 41)
+
+        # and a single insert of the events
+        with self.settings(RESTURO_SIGNAL_OUTBOX=True):
+            Invite.objects.all().delete()
+            with self.assertNumQueries(8 + 2 + 1):
+                self.invite(handles)
+        self.assertEquals(SignalEvent.objects.count(), 40)
+
+    def test_atomic(self):
+        """ the invites are stored together with their events """
+        with self.settings(RESTURO_SIGNAL_OUTBOX=True), \
+                mock.patch.object(SignalEvent.objects, 'bulk_create',
+                                  side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.invite(["a@example.com", "b@example.com"])
+        self.assertEquals(Invite.objects.count(), 0)
+
+    def test_signals(self):
+        UserFactory.create(username="existing")
+
+        with mock_signal_receiver(user_existing_invite) as existing:
+            with mock_signal_receiver(user_email_invite) as email:
+                self.invite(["existing", "a@example.com", "b@example.com"])
+                self.assertEqual(existing.call_count, 1)
+                self.assertEqual(email.call_count, 2)
+                self.assertTrue(email.call_args[1]['invite'].pk)
+
+    @override_settings(RESTURO_SEND_INVITE=True)
+    def test_mail_failure(self):
+        """ the invites are created even if they can't be mailed """
+        with mock.patch('resturo.mail.send_messages',
+                        side_effect=smtplib.SMTPException("down")), \
+                self.assertLogs('resturo.mail', logging.ERROR):
+            response = self.invite(["a@example.com", "b@example.com"])
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(Invite.objects.count(), 2)
+
+    def test_empty(self):
+        response = self.invite([])
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_limit(self):
+        with self.settings(RESTURO_BULK_INVITE_LIMIT=2):
+            response = self.invite(["a@example.com", "b@example.com",
+                                    "c@example.com"])
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(Invite.objects.count(), 0)
+
+    def test_must_be_member_to_invite(self):
+        organization = OrganizationFactory.create()
+        response = self.client.post(
+            reverse('resturo_organization_bulk_invite',
+                    kwargs={'pk': organization.pk}),
+            {"handles": ["a@example.com"], "role": 2, "strict": False},
+            format='json')
+
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
 class TestAcceptInvite(APITestCase):
 
     def setUp(self):
@@ -245,6 +716,30 @@ class TestAcceptInvite(APITestCase):
         # The invite should be gone
         self.assertEquals(Invite.objects.count(), 0)
 
+    def test_token_case_insensitive(self):
+        i = InviteFactory.create(user=self.u)
+
+        response = self.client.post(reverse('resturo_organization_join'),
+                                    {"token": i.token.upper(),
+                                     "action": JoinSerializer.JOIN_ACCEPT})
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(Invite.objects.count(), 0)
+
+    def test_join_query_count(self):
+        i = InviteFactory.create(user=self.u, role=2)
+
+        # session and user, the transaction (a savepoint within the test
+        # case), the locked invite, the membership insert in a savepoint
+        # and the invite delete
+        with self.assertNumQueries(2 + 2 + 1 + 3 + 1):
+            response = self.client.post(reverse('resturo_organization_join'),
+                                        {"token": i.token,
+                                         "action": JoinSerializer.JOIN_ACCEPT})
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(Membership.objects.get(user=self.u).role, 2)
+
     def test_invalid_token(self):
         i = InviteFactory.create(user=self.u)
 
@@ -315,6 +810,17 @@ class TestAcceptInvite(APITestCase):
         # The invite is still present
         self.assertEquals(Invite.objects.count(), 1)
 
+    def test_other_integrity_error(self):
+        """ only the membership constraint means "already member" """
+        i = InviteFactory.create(user=self.u)
+
+        with mock.patch.object(Membership.objects, 'create',
+                               side_effect=IntegrityError("NOT NULL")):
+            with self.assertRaises(IntegrityError):
+                self.client.post(reverse('resturo_organization_join'),
+                                 {"token": i.token,
+                                  "action": JoinSerializer.JOIN_ACCEPT})
+
     def test_user_already_member_reject(self):
         """ invites cannot be used on members or to change roles.
             The invite can be rejected """
@@ -356,3 +862,139 @@ class TestAcceptInvite(APITestCase):
                                      "action": JoinSerializer.JOIN_ACCEPT})
 
         self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+@override_settings(RESTURO_INVITE_STATELESS=True)
+class TestSignedInvite(APITestCase):
+
+    def setUp(self):
+        self.m = MembershipFactory.create()
+        self.o = self.m.organization
+        self.u = UserFactory.create()
+        self.client.force_login(self.m.user)
+
+    def invite(self, handles):
+        with mock_signal_receiver(user_email_invite) as email_invite, \
+                mock_signal_receiver(user_existing_invite) as user_invite:
+            response = self.client.post(
+                reverse('resturo_organization_bulk_invite',
+                        kwargs={'pk': self.o.pk}),
+                {"handles": handles, "role": 2, "strict": False},
+                format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return [c[1]['invite'].token for c in
+                user_invite.call_args_list + email_invite.call_args_list]
+
+    def join(self, token, action=JoinSerializer.JOIN_ACCEPT):
+        return self.client.post(reverse('resturo_organization_join'),
+                                {"token": token, "action": action},
+                                format='json')
+
+    def test_no_rows(self):
+        tokens = self.invite([self.u.username, "x@example.com"])
+        self.assertEquals(len(tokens), 2)
+        self.assertEquals(Invite.objects.count(), 0)
+
+    def test_single_invite(self):
+        with mock_signal_receiver(user_existing_invite) as receiver:
+            response = self.client.post(
+                reverse('resturo_organization_invite',
+                        kwargs={'pk': self.o.pk}),
+                {"handle": self.u.username, "role": 2, "strict": False},
+                format='json')
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+            invite = receiver.call_args[1]['invite']
+
+        self.assertIsNone(invite.pk)
+        self.assertEquals(Invite.objects.count(), 0)
+        self.client.force_login(self.u)
+        self.assertEquals(self.join(invite.token).status_code,
+                          status.HTTP_200_OK)
+
+    def test_accept(self):
+        token, = self.invite([self.u.username])
+        self.client.force_login(self.u)
+
+        # session and user, then only the revocation and membership inserts
+        # (and their savepoints), no invite lookup
+        with self.assertNumQueries(2 + 8):
+            response = self.join(token)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(
+            Membership.objects.get(user=self.u, organization=self.o).role, 2)
+
+    def test_single_use(self):
+        token, = self.invite([self.u.username])
+        self.client.force_login(self.u)
+
+        self.assertEquals(self.join(token, JoinSerializer.JOIN_REJECT)
+                          .status_code, status.HTTP_200_OK)
+        self.assertEquals(self.join(token).status_code,
+                          status.HTTP_404_NOT_FOUND)
+        self.assertFalse(Membership.objects.filter(user=self.u).exists())
+
+    def test_already_member_keeps_token(self):
+        token, = self.invite([self.u.username])
+        Membership.objects.create(user=self.u, organization=self.o)
+        self.client.force_login(self.u)
+
+        self.assertEquals(self.join(token).status_code,
+                          status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(RevokedInvite.objects.count(), 0)
+
+    def test_organization_deleted(self):
+        token, = self.invite([self.u.username])
+        self.o.delete()
+        self.client.force_login(self.u)
+
+        # the foreign key violation, where the database enforces it
+        with mock.patch.object(Membership.objects, 'create',
+                               side_effect=IntegrityError("FOREIGN KEY")):
+            response = self.join(token)
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_revoked(self):
+        token, = self.invite([self.u.username])
+        self.assertTrue(revoke_invite_token(token))
+        self.assertFalse(revoke_invite_token(token))
+
+        self.client.force_login(self.u)
+        self.assertEquals(self.join(token).status_code,
+                          status.HTTP_404_NOT_FOUND)
+
+    def test_tampered(self):
+        token, = self.invite([self.u.username])
+        self.client.force_login(self.u)
+
+        # only session and user
+        with self.assertNumQueries(2):
+            response = self.join(token[:-1])
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_expired(self):
+        token, = self.invite([self.u.username])
+        self.client.force_login(self.u)
+
+        with self.settings(RESTURO_INVITE_MAX_AGE=-1):
+            self.assertEquals(self.join(token).status_code,
+                              status.HTTP_404_NOT_FOUND)
+
+
+class TestModelResolver(TestCase):
+
+    def test_resolve(self):
+        self.assertIs(modelresolver('Membership'), Membership)
+        self.assertIs(modelresolver.models.Invite, Invite)
+        self.assertEquals(modelresolver.Invite, 'tests.Invite')
+
+    def test_cached(self):
+        modelresolver('Membership')
+        with mock.patch('resturo.models.apps.get_model') as get_model:
+            self.assertIs(modelresolver('Membership'), Membership)
+            self.assertFalse(get_model.called)
+
+    def test_override_settings(self):
+        modelresolver('Membership')
+        with self.settings(MODELS={'Membership': 'tests.Invite'}):
+            self.assertIs(modelresolver('Membership'), Invite)
+        self.assertIs(modelresolver('Membership'), Membership)
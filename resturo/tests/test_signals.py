@@ -0,0 +1,168 @@
+import json
+
+from django.db import IntegrityError
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.utils import timezone
+from mock_django.signals import mock_signal_receiver
+
+from .factories import UserFactory
+from ..models import SignalEvent
+from ..signals import send, dispatch_outbox, user_rest_created
+from ..signals import atomic_signals
+from ..signals import user_existing_invite
+from .models import Invite
+
+
+class TestSend(TestCase):
+
+    def test_direct(self):
+        """ without outbox signals are sent right away """
+        u = UserFactory.create()
+        with mock_signal_receiver(user_rest_created) as receiver:
+            send(user_rest_created, sender=None, user=u)
+            self.assertEqual(receiver.call_count, 1)
+        self.assertEquals(SignalEvent.objects.count(), 0)
+
+    def test_atomic(self):
+        """ within atomic_signals() signals are sent when the block exits """
+        u = UserFactory.create()
+        with mock_signal_receiver(user_rest_created) as receiver:
+            with atomic_signals():
+                send(user_rest_created, sender=None, user=u)
+                with atomic_signals():
+                    send(user_rest_created, sender=None, user=u)
+                self.assertEqual(receiver.call_count, 0)
+            self.assertEqual(receiver.call_count, 2)
+
+    def test_atomic_rollback(self):
+        """ signals are dropped with the changes they report """
+        u = UserFactory.create()
+        with mock_signal_receiver(user_rest_created) as receiver:
+            with self.assertRaises(ValueError):
+                with atomic_signals():
+                    send(user_rest_created, sender=None, user=u)
+                    raise ValueError
+            self.assertEqual(receiver.call_count, 0)
+
+            # and don't leak into the next block
+            with atomic_signals():
+                pass
+            self.assertEqual(receiver.call_count, 0)
+
+
+@override_settings(RESTURO_SIGNAL_OUTBOX=True)
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        self.u = UserFactory.create()
+
+    def test_stored(self):
+        with mock_signal_receiver(user_rest_created) as receiver:
+            send(user_rest_created, sender=None, user=self.u)
+            self.assertEqual(receiver.call_count, 0)
+
+        event = SignalEvent.objects.get()
+        self.assertEquals(event.signal, 'user_rest_created')
+        self.assertEquals(json.loads(event.payload)['kwargs']['user'],
+                          {'model': 'auth.User', 'pk': self.u.pk})
+
+    def test_unsaved_instance(self):
+        """ unsaved instances (signed invites) are stored by value """
+        invite = Invite(user=self.u, inviter=self.u, organization_id=1,
+                        token='signed:token')
+        send(user_existing_invite, sender=None, invite=invite)
+
+        with mock_signal_receiver(user_existing_invite) as receiver:
+            self.assertEquals(dispatch_outbox(), 1)
+            delivered = receiver.call_args[1]['invite']
+        self.assertIsNone(delivered.pk)
+        self.assertEquals(delivered.token, 'signed:token')
+        self.assertEquals(delivered.user, self.u)
+
+    def test_dispatch(self):
+        send(user_rest_created, sender=None, user=self.u)
+
+        with mock_signal_receiver(user_rest_created) as receiver:
+            self.assertEquals(dispatch_outbox(), 1)
+            self.assertEqual(receiver.call_count, 1)
+            self.assertEquals(receiver.call_args[1]['user'], self.u)
+        self.assertEquals(SignalEvent.objects.count(), 0)
+
+    def test_retry(self):
+        """ failed deliveries are retried later """
+        send(user_rest_created, sender=None, user=self.u)
+
+        with mock_signal_receiver(user_rest_created) as receiver:
+            receiver.side_effect = ValueError("smtp down")
+            dispatch_outbox()
+
+        event = SignalEvent.objects.get()
+        self.assertEquals(event.attempts, 1)
+        self.assertFalse(event.failed)
+        self.assertGreater(event.available, timezone.now())
+        self.assertIn("smtp down", event.last_error)
+
+        # not available yet
+        self.assertEquals(dispatch_outbox(), 0)
+
+    def test_atomic(self):
+        with atomic_signals():
+            send(user_rest_created, sender=None, user=self.u)
+        self.assertEquals(SignalEvent.objects.count(), 1)
+
+        with self.assertRaises(ValueError):
+            with atomic_signals():
+                send(user_rest_created, sender=None, user=self.u)
+                raise ValueError
+        self.assertEquals(SignalEvent.objects.count(), 1)
+
+    def test_database_error(self):
+        """ a receiver's database error doesn't break the batch """
+        send(user_rest_created, sender=None, user=self.u)
+        send(user_rest_created, sender=None, user=self.u)
+
+        def create(sender, user, **kwargs):
+            UserFactory.create(username=user.username)
+
+        with mock_signal_receiver(user_rest_created) as receiver:
+            receiver.side_effect = create
+            self.assertEquals(dispatch_outbox(), 2)
+
+        self.assertEquals(
+            list(SignalEvent.objects.values_list('attempts', flat=True)),
+            [1, 1])
+        self.assertIn(IntegrityError.__name__,
+                      SignalEvent.objects.first().last_error)
+
+    def test_give_up(self):
+        send(user_rest_created, sender=None, user=self.u)
+
+        with mock_signal_receiver(user_rest_created) as receiver:
+            receiver.side_effect = ValueError
+            for i in range(3):
+                SignalEvent.objects.update(available=timezone.now())
+                dispatch_outbox(max_attempts=3)
+
+        event = SignalEvent.objects.get()
+        self.assertEquals(event.attempts, 3)
+        self.assertTrue(event.failed)
+
+    def test_batch(self):
+        for i in range(5):
+            send(user_rest_created, sender=None, user=self.u)
+
+        with mock_signal_receiver(user_rest_created) as receiver:
+            self.assertEquals(dispatch_outbox(batch_size=2), 2)
+            self.assertEqual(receiver.call_count, 2)
+        self.assertEquals(SignalEvent.objects.count(), 3)
+
+    def test_command(self):
+        for i in range(5):
+            send(user_rest_created, sender=None, user=self.u)
+
+        with mock_signal_receiver(user_rest_created) as receiver:
+            call_command('resturo_dispatch_signals', once=True,
+                         batch_size=2)
+            self.assertEqual(receiver.call_count, 5)
+        self.assertEquals(SignalEvent.objects.count(), 0)
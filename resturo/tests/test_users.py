@@ -0,0 +1,86 @@
+import importlib
+
+from unittest import mock
+
+from django.apps import apps as django_apps
+from django.db import models
+from django.test import TestCase
+
+from .factories import UserFactory
+from ..users import get_user_by_handle
+
+
+class TestGetUserByHandle(TestCase):
+
+    def test_email(self):
+        u = UserFactory.create(email="test@example.com")
+        self.assertEquals(get_user_by_handle("test@example.com"), u)
+
+    def test_username(self):
+        u = UserFactory.create(username="test")
+        self.assertEquals(get_user_by_handle("test"), u)
+
+    def test_case_insensitive(self):
+        """ mixed case emails and usernames are found """
+        u = UserFactory.create(username="Test", email="Test@Example.com")
+        self.assertEquals(get_user_by_handle("test@example.com"), u)
+        self.assertEquals(get_user_by_handle(" TEST "), u)
+
+    def test_email_preferred(self):
+        """ an email match wins over a username match """
+        UserFactory.create(username="test@example.com",
+                           email="other@example.com")
+        u = UserFactory.create(username="test", email="test@example.com")
+        self.assertEquals(get_user_by_handle("test@example.com"), u)
+
+    def test_single_query(self):
+        UserFactory.create(username="test")
+        with self.assertNumQueries(1):
+            get_user_by_handle("unknown")
+
+    def test_empty(self):
+        UserFactory.create(username="test", email="")
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_user_by_handle(" "))
+
+
+class TestHandleIndexMigration(TestCase):
+
+    def test_missing_fields(self):
+        """ custom user models without a handle field are skipped """
+        migration = importlib.import_module(
+            'resturo.migrations.0004_user_handle_indexes')
+
+        class HandleUser(models.Model):
+            username = models.CharField(max_length=10, db_column='login')
+
+            class Meta:
+                app_label = 'tests'
+
+        apps = mock.Mock(**{"get_model.return_value": HandleUser})
+        self.assertEquals(list(migration.handle_columns(apps)),
+                          [('resturo_user_username_lower', 'login')])
+
+    def test_postgresql(self):
+        """ plain CREATE INDEX, PostgreSQL doesn't allow CONCURRENTLY in
+            the transaction Django 1.9 runs migrations in """
+        migration = importlib.import_module(
+            'resturo.migrations.0004_user_handle_indexes')
+        schema_editor = mock.Mock(**{
+            "connection.vendor": "postgresql",
+            "quote_name.side_effect": lambda name: '"{0}"'.format(name)})
+
+        migration.create_handle_indexes(django_apps, schema_editor)
+        self.assertEquals(
+            [c[0][0] for c in schema_editor.execute.call_args_list],
+            ['CREATE INDEX "resturo_user_email_lower" '
+             'ON "auth_user" (LOWER("email"))',
+             'CREATE INDEX "resturo_user_username_lower" '
+             'ON "auth_user" (LOWER("username"))'])
+
+        schema_editor.reset_mock()
+        migration.drop_handle_indexes(django_apps, schema_editor)
+        self.assertEquals(
+            [c[0][0] for c in schema_editor.execute.call_args_list],
+            ['DROP INDEX IF EXISTS "resturo_user_email_lower"',
+             'DROP INDEX IF EXISTS "resturo_user_username_lower"'])
@@ -0,0 +1,111 @@
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.db import transaction, IntegrityError
+from django.utils.crypto import salted_hmac
+
+from .models import RevokedInvite, modelresolver
+
+VERIFICATION_SALT = 'resturo.tokens.verification'
+
+
+def is_stateless_verification():
+    return getattr(settings, "RESTURO_VERIFY_EMAIL_STATELESS", False)
+
+
+def email_hash(email):
+    """ keyed hash of the normalized email address, so a token becomes
+        invalid when the address changes without disclosing it """
+    return salted_hmac(VERIFICATION_SALT,
+                       email.strip().lower()).hexdigest()[:16]
+
+
+def make_verification_token(user):
+    """ a signed, timestamped token holding the user id and a hash of the
+        email address to verify """
+    return signing.dumps([user.pk, email_hash(user.email)],
+                         salt=VERIFICATION_SALT)
+
+
+def check_verification_token(token):
+    """ Return (user id, email hash) from a valid token, or None if the
+        token is invalid or older than RESTURO_VERIFY_EMAIL_MAX_AGE """
+    max_age = getattr(settings, "RESTURO_VERIFY_EMAIL_MAX_AGE",
+                      3 * 24 * 60 * 60)
+    try:
+        user_id, hashed = signing.loads(token, salt=VERIFICATION_SALT,
+                                        max_age=max_age)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    return user_id, hashed
+
+
+def is_signed_verification_token(token):
+    """ signed tokens contain the signer's separator, uuid tokens don't """
+    return ':' in token
+
+
+def verification_token(user):
+    """ the token to send to user for verifying its email address """
+    if is_stateless_verification():
+        return make_verification_token(user)
+    return user.verification.token
+
+
+INVITE_SALT = 'resturo.tokens.invite'
+
+
+def is_stateless_invite():
+    return getattr(settings, "RESTURO_INVITE_STATELESS", False)
+
+
+def is_signed_invite_token(token):
+    """ signed tokens contain the signer's separator, uuid tokens don't """
+    return ':' in token
+
+
+def sign_invites(invites):
+    """ Give each (unsaved) invite a signed token holding the invite and a
+        unique id instead of storing it. The token replaces invite.token.
+    """
+    for invite in invites:
+        invite.token = signing.dumps(
+            {'j': uuid.uuid4().hex, 'o': invite.organization_id,
+             'u': invite.user_id, 'i': invite.inviter_id,
+             'e': invite.email, 'r': invite.role, 's': invite.strict},
+            salt=INVITE_SALT, compress=True)
+    return invites
+
+
+def load_invite_token(token):
+    """ Return (token id, unsaved Invite) from a valid signed invite token,
+        or None if the token is invalid or older than
+        RESTURO_INVITE_MAX_AGE. Revocations are not checked.
+    """
+    max_age = getattr(settings, "RESTURO_INVITE_MAX_AGE",
+                      14 * 24 * 60 * 60)
+    try:
+        data = signing.loads(token, salt=INVITE_SALT, max_age=max_age)
+        invite = modelresolver.models.Invite(
+            organization_id=data['o'], user_id=data['u'],
+            inviter_id=data['i'], email=data['e'], role=data['r'],
+            strict=data['s'], token=token)
+        return data['j'], invite
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        return None
+
+
+def revoke_invite_token(token):
+    """ Cancel a signed invite token. Returns False if the token is invalid
+        or was already used or cancelled. """
+    loaded = load_invite_token(token)
+    if loaded is None:
+        return False
+
+    try:
+        with transaction.atomic():
+            RevokedInvite.objects.create(jti=loaded[0])
+    except IntegrityError:
+        return False
+    return True
@@ -28,6 +28,9 @@ organizations_patterns = patterns(
     url(r'^(?P<pk>[0-9]+)/invite$',
         views.OrganizationInvite.as_view(),
         name='resturo_organization_invite'),
+    url(r'^(?P<pk>[0-9]+)/invite/bulk$',
+        views.OrganizationBulkInvite.as_view(),
+        name='resturo_organization_bulk_invite'),
     url(r'^join$',
         views.OrganizationJoin.as_view(),
         name='resturo_organization_join'),
@@ -0,0 +1,56 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Q, Case, When, IntegerField
+from django.db.models.functions import Lower
+
+
+def annotate_handles(queryset):
+    return queryset.annotate(email_lower=Lower('email'),
+                             username_lower=Lower('username'))
+
+
+def get_user_by_handle(handle):
+    """ Find a user by email address or username, case insensitive, in a
+        single query. An email match is preferred over a username match.
+
+        The LOWER() comparisons can use the functional indexes created by
+        the 0004_user_handle_indexes migration.
+    """
+    handle = handle.strip().lower()
+    if not handle:
+        return None
+
+    return annotate_handles(get_user_model().objects).filter(
+        Q(email_lower=handle) | Q(username_lower=handle)
+    ).order_by(
+        Case(When(email_lower=handle, then=0), default=1,
+             output_field=IntegerField()),
+        'pk'
+    ).first()
+
+
+def get_users_by_handles(handles):
+    """ Resolve many handles with a single query. Returns a dict mapping
+        each lowercased handle to its user; handles that don't match a
+        user are left out. As with get_user_by_handle, an email match is
+        preferred over a username match.
+    """
+    handles = set(handle.strip().lower() for handle in handles)
+    handles.discard('')
+    if not handles:
+        return {}
+
+    users = annotate_handles(get_user_model().objects).filter(
+        Q(email_lower__in=handles) | Q(username_lower__in=handles)
+    ).order_by('pk')
+
+    found = {}
+    by_username = {}
+    for user in users:
+        if user.email_lower in handles:
+            found.setdefault(user.email_lower, user)
+        if user.username_lower in handles:
+            by_username.setdefault(user.username_lower, user)
+
+    for handle, user in by_username.items():
+        found.setdefault(handle, user)
+    return found
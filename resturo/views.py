@@ -1,36 +1,87 @@
+import copy
+import json
+import uuid
+
 from django.contrib.auth.models import User
 from rest_framework import generics, response, status
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
 from django.contrib.auth.tokens import default_token_generator
 from django.conf import settings
 
 from .serializers import UserSerializer, UserCreateSerializer
 from .serializers import PasswordResetSerializer
 from .serializers import OrganizationSerializer
-from .serializers import InviteSerializer
+from .serializers import InviteSerializer, BulkInviteSerializer
 from .serializers import JoinSerializer
 
 from .signals import user_password_reset, user_rest_created
 from .signals import user_password_confirm, user_rest_emailchange
 from .signals import user_existing_invite, user_email_invite
 from .signals import user_email_verified
+from .signals import send, send_bulk, atomic_signals
 
-from .models import EmailVerification
+from .models import EmailVerification, RevokedInvite
 from .models import modelresolver
 
 from .permissions import OrganizationPermission
-
-
-class UserCreateView(generics.ListCreateAPIView):
+from .pagination import PrimaryKeyCursorPagination
+from .users import get_user_by_handle, get_users_by_handles
+from .mail import mail_batch
+from .instrumentation import InstrumentedViewMixin, measure
+from .tokens import check_verification_token, is_signed_verification_token
+from .tokens import email_hash
+from .tokens import is_stateless_invite, is_signed_invite_token
+from .tokens import sign_invites, load_invite_token
+
+
+def stream_ndjson(queryset, serializer_class, context=None,
+                  chunk_size=500):
+    """ Serialize queryset as newline delimited json. Rows are read with
+        iterator() and serialized chunk_size at a time, so memory use does
+        not depend on the size of the queryset.
+    """
+    chunk = []
+    for obj in queryset.iterator():
+        chunk.append(obj)
+        if len(chunk) == chunk_size:
+            for item in serializer_class(chunk, many=True,
+                                         context=context).data:
+                yield json.dumps(item, cls=JSONEncoder) + '\n'
+            chunk = []
+
+    for item in serializer_class(chunk, many=True, context=context).data:
+        yield json.dumps(item, cls=JSONEncoder) + '\n'
+
+
+class UserCreateView(InstrumentedViewMixin, generics.ListCreateAPIView):
     serializer_class = UserSerializer
     model = User
+    pagination_class = PrimaryKeyCursorPagination
+    query_budget = {'GET': 3, 'POST': 6}
 
     permission_classes = (AllowAny,)
 
+    def list(self, request, *args, **kwargs):
+        """
+            List users, paginated by cursor. ?export=ndjson streams all
+            users as newline delimited json instead.
+        """
+        if request.query_params.get('export') == 'ndjson':
+            queryset = self.filter_queryset(self.get_queryset())
+            return StreamingHttpResponse(
+                stream_ndjson(queryset.order_by('pk'),
+                              self.get_serializer_class(),
+                              context=self.get_serializer_context()),
+                content_type='application/x-ndjson')
+        return super().list(request, *args, **kwargs)
+
     def create(self, request, *args, **kwargs):
         """
             require username, password, email
@@ -41,10 +92,12 @@ class UserCreateView(generics.ListCreateAPIView):
         #  make this serializer more dynamic
         serializer = UserCreateSerializer(data=request.data)
         if serializer.is_valid():
-            self.object = serializer.save()
-            self.object.is_active = True
-            self.object.save()
-            user_rest_created.send_robust(sender=None, user=self.object)
+            # the user (and, if enabled, its email verification) is
+            # created with a single insert each. Receivers (the welcome
+            # mail) run once the transaction is committed
+            with atomic_signals():
+                self.object = serializer.save()
+                send(user_rest_created, sender=None, user=self.object)
             #  Do organization magic
             headers = self.get_success_headers(serializer.data)
             return response.Response(serializer.data,
@@ -54,45 +107,60 @@ class UserCreateView(generics.ListCreateAPIView):
                                  status=status.HTTP_400_BAD_REQUEST)
 
     def get_queryset(self):
+        # UserSerializer.get_verified reads the verification relation
+        queryset = self.model.objects.select_related('verification')
         if self.request.user.is_superuser:
-            return self.model.objects.all()
+            return queryset.all()
         else:
-            return self.model.objects.filter(id=self.request.user.id)
+            return queryset.filter(id=self.request.user.id)
 
 
-class UserDetailView(generics.RetrieveUpdateAPIView):
+class UserDetailView(InstrumentedViewMixin, generics.RetrieveUpdateAPIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = UserSerializer
     model = User
+    query_budget = {'GET': 3, 'PUT': 8, 'PATCH': 8}
 
     def get_queryset(self):
+        # UserSerializer.get_verified reads the verification relation
+        queryset = self.model.objects.select_related('verification')
         if self.request.user.is_superuser:
-            return self.model.objects.all()
+            return queryset.all()
         else:
-            return self.model.objects.filter(id=self.request.user.id)
+            return queryset.filter(id=self.request.user.id)
 
     def handle_email_change(self, before, after, force=False):
+        """ reset the email verification of after, the updated user, if
+            its email address differs from before, the user as it was
+            before the update """
         if not getattr(settings, "RESTURO_VERIFY_EMAIL", False):
             return
 
         if force or (before.email.strip().lower() !=
-           after.email.strip().lower()):
-            verification, _ = EmailVerification.objects.get_or_create(
-                user=after)
+                     after.email.strip().lower()):
+            # the verification has been fetched along with the user
+            try:
+                verification = after.verification
+            except EmailVerification.DoesNotExist:
+                verification = EmailVerification(user=after)
             verification.previous = before.email
             verification.reset()
-            user_rest_emailchange.send_robust(sender=None, user=after)
+            send(user_rest_emailchange, sender=None, user=after)
 
-    def update(self, request, *args, **kwargs):
+    def perform_update(self, serializer):
         """ Check if email address has changed. If so, fire signal """
-        instance_before = self.get_object()
-        res = super().update(request, *args, **kwargs)
-        self.handle_email_change(instance_before, self.get_object())
-        return res
+        # a shallow copy is enough, the update only sets attributes
+        before = copy.copy(serializer.instance)
+        # the update, the verification reset and its signal commit
+        # together
+        with atomic_signals():
+            super().perform_update(serializer)
+            self.handle_email_change(before, serializer.instance)
 
 
-class UserSelfView(generics.RetrieveAPIView):
+class UserSelfView(InstrumentedViewMixin, generics.RetrieveAPIView):
     serializer_class = UserSerializer
+    query_budget = {'GET': 3}
 
     def get_object(self, queryset=None):
         if not self.request.user.is_authenticated():
@@ -100,9 +168,10 @@ class UserSelfView(generics.RetrieveAPIView):
         return self.request.user
 
 
-class PasswordResetView(APIView):
+class PasswordResetView(InstrumentedViewMixin, APIView):
     authentication_classes = ()
     permission_classes = (AllowAny,)
+    query_budget = {'GET': 2, 'POST': 5}
 
     def get(self, request, format=None):
         """ Find user and fire signal for sending password reset email
@@ -111,12 +180,10 @@ class PasswordResetView(APIView):
         """
         handle = request.GET.get('handle', '').strip().lower()
         if handle:
-            user = User.objects.filter(email=handle).first()
-            if not user:
-                user = User.objects.filter(username=handle).first()
+            user = get_user_by_handle(handle)
 
             if user and user.is_active:
-                user_password_reset.send_robust(sender=None, user=user)
+                send(user_password_reset, sender=None, user=user)
         return Response({"status": "ok"})
 
     def post(self, request, format=None):
@@ -148,68 +215,140 @@ class PasswordResetView(APIView):
                                      status=status.HTTP_400_BAD_REQUEST)
 
         if default_token_generator.check_token(user, token):
-            user.set_password(password)
-            user.save()
-            user_password_confirm.send_robust(sender=None, user=user)
+            with measure('password.hash'):
+                user.set_password(password)
+            with atomic_signals():
+                user.save()
+                send(user_password_confirm, sender=None, user=user)
             return Response({"status": "ok"})
 
         return response.Response({"non_field_errors": ["invalid token"]},
                                  status=status.HTTP_400_BAD_REQUEST)
 
 
-class EmailVerificationView(APIView):
+class EmailVerificationView(InstrumentedViewMixin, APIView):
     authentication_classes = ()
     permission_classes = (AllowAny,)
+    query_budget = {'GET': 6}
 
     def get(self, request, format=None):
         """
-            Verify email
+            Verify email. Signed and stored tokens are both accepted,
+            whatever RESTURO_VERIFY_EMAIL_STATELESS is, so links sent
+            before it changed keep working.
         """
-        token = request.GET.get('token', '').strip().lower()
+        token = request.GET.get('token', '').strip()
+        if is_signed_verification_token(token):
+            return self.verify_signed(token)
+
+        # tokens are stored lowercase, an exact match can use the index
+        token = token.lower()
         if token:
             try:
                 verification = EmailVerification.objects.get(token=token)
                 if not verification.verified:
                     verification.verified = True
-                    verification.save()
-                    user_email_verified.send_robust(sender=None,
-                                                    user=verification.user)
+                    with atomic_signals():
+                        verification.save()
+                        send(user_email_verified, sender=None,
+                             user=verification.user)
                 return Response({"status": "ok"})
             except EmailVerification.DoesNotExist:
                 pass
         return response.Response({"non_field_errors": ["invalid token"]},
                                  status=status.HTTP_400_BAD_REQUEST)
 
+    def verify_signed(self, token):
+        """
+            Verify a signed token. The signature is checked without any
+            lookup; the user is fetched by primary key for the email
+            address check and the signal.
+        """
+        value = check_verification_token(token)
+        if value is not None:
+            user_id, hashed = value
+            user = User.objects.select_related('verification').filter(
+                pk=user_id).first()
+            if user is not None and email_hash(user.email) == hashed:
+                try:
+                    verification = user.verification
+                except EmailVerification.DoesNotExist:
+                    verification = None
+
+                if verification is not None and not verification.verified:
+                    verification.verified = True
+                    with atomic_signals():
+                        verification.save(update_fields=['verified'])
+                        send(user_email_verified, sender=None, user=user)
+                return Response({"status": "ok"})
+        return response.Response({"non_field_errors": ["invalid token"]},
+                                 status=status.HTTP_400_BAD_REQUEST)
+
 
-class OrganizationList(generics.ListCreateAPIView):
+class OrganizationList(InstrumentedViewMixin, generics.ListCreateAPIView):
     model = modelresolver("Organization")
     serializer_class = OrganizationSerializer
+    pagination_class = PrimaryKeyCursorPagination
+    query_budget = {'GET': 3, 'POST': 3}
 
     def get_queryset(self):
-        if self.request.user.is_superuser:
-            return self.model.objects.all()
-        #  TODO: add role user has in this org
-        return self.request.user.organizations.all()
-
-
-class OrganizationDetail(generics.RetrieveUpdateDestroyAPIView):
+        """ organizations annotated with the role the user has in them """
+        user = self.request.user
+        Membership = modelresolver.models.Membership
+
+        if user.is_superuser:
+            # superusers see all organizations, including those they're not
+            # a member of; fetch their role with a correlated subquery
+            qn = connection.ops.quote_name
+            membership = Membership._meta
+            role = ('SELECT {0}.{1} FROM {0} '
+                    'WHERE {0}.{2} = {3}.{4} AND {0}.{5} = %s').format(
+                qn(membership.db_table),
+                qn(membership.get_field('role').column),
+                qn(membership.get_field('organization').column),
+                qn(self.model._meta.db_table),
+                qn(self.model._meta.pk.column),
+                qn(membership.get_field('user').column))
+            return self.model.objects.extra(select={'role': role},
+                                            select_params=(user.pk,))
+
+        # join through the membership used to filter on the user
+        membership = Membership._meta.get_field(
+            'organization').related_query_name()
+        return self.model.objects.filter(**{
+            membership + '__user': user
+        }).annotate(role=F(membership + '__role'))
+
+
+class OrganizationDetail(InstrumentedViewMixin,
+                         generics.RetrieveUpdateDestroyAPIView):
     model = modelresolver("Organization")
     serializer_class = OrganizationSerializer
+    query_budget = {'GET': 3, 'PUT': 4, 'PATCH': 4, 'DELETE': 7}
 
     def get_queryset(self):
         return self.model.objects.all()
 
 
-class OrganizationInvite(generics.CreateAPIView):
+class OrganizationInvite(InstrumentedViewMixin, generics.CreateAPIView):
     model = modelresolver("Organization")
     serializer_class = InviteSerializer
     permission_classes = (IsAuthenticated, OrganizationPermission)
+    query_budget = {'POST': 10}
 
     def get_queryset(self):
         if self.request.user.is_superuser:
             return self.model.objects.all()
         return self.model.objects.all()
 
+    def get_object(self):
+        """ the organization, fetched at most once per request """
+        try:
+            return self._organization
+        except AttributeError:
+            self._organization = super().get_object()
+        return self._organization
+
     def create(self, request, *args, **kwargs):
         """ create, accept or reject an invite """
         org = self.get_object()
@@ -227,12 +366,10 @@ class OrganizationInvite(generics.CreateAPIView):
         role = data.get('role', 0)
         strict = data.get('strict', False)
 
-        user = User.objects.filter(email=handle).first()
-        if not user:
-            user = User.objects.filter(username=handle).first()
+        user = get_user_by_handle(handle)
 
         if user:
-            if org in user.organizations.all():
+            if modelresolver.models.Membership.is_member(user, org):
                 return response.Response(
                     {"non_field_errors": ["User is already member"]},
                     status=status.HTTP_400_BAD_REQUEST)
@@ -241,25 +378,117 @@ class OrganizationInvite(generics.CreateAPIView):
                 {"handle": ["Does not match user or existing email"]},
                 status=status.HTTP_400_BAD_REQUEST)
 
-        invite = modelresolver('Invite')(user=user, inviter=self.request.user,
-                                         email=email,
-                                         role=role, strict=strict,
-                                         organization=org)
-        invite.save()
+        invite = modelresolver.models.Invite(user=user,
+                                             inviter=self.request.user,
+                                             email=email,
+                                             role=role, strict=strict,
+                                             organization=org)
+        with atomic_signals():
+            if is_stateless_invite():
+                sign_invites([invite])
+            else:
+                invite.save()
 
-        # At this point we have a valid user or a somewhat valid email.
-        # Fire signal so email can be sent
+            # At this point we have a valid user or a somewhat valid email.
+            # Fire signal so email can be sent
 
-        if user and user.is_active:
-            user_existing_invite.send_robust(sender=org, invite=invite)
-        else:  # must be email
-            user_email_invite.send_robust(sender=org, invite=invite)
+            if user and user.is_active:
+                send(user_existing_invite, sender=org, invite=invite)
+            else:  # must be email
+                send(user_email_invite, sender=org, invite=invite)
         return Response({"status": "ok"})
 
 
-class OrganizationJoin(APIView):
+class OrganizationBulkInvite(OrganizationInvite):
+    serializer_class = BulkInviteSerializer
+    query_budget = {'POST': 11}
+
+    def create(self, request, *args, **kwargs):
+        """ invite a list of handles, reporting the result per handle """
+        org = self.get_object()
+        deserialized = self.serializer_class(data=request.data)
+
+        if not deserialized.is_valid():
+            return response.Response(
+                deserialized.errors,
+                status=status.HTTP_400_BAD_REQUEST)
+
+        data = deserialized.data
+
+        handles = data['handles']
+        role = data.get('role', 0)
+        strict = data.get('strict', False)
+
+        limit = getattr(settings, "RESTURO_BULK_INVITE_LIMIT", 5000)
+        if len(handles) > limit:
+            return response.Response(
+                {"handles": ["At most {0} handles allowed".format(limit)]},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        inviteclass = modelresolver.models.Invite
+
+        users = get_users_by_handles(handles)
+        members = set(modelresolver.models.Membership.objects.filter(
+            organization=org,
+            user__in=[user.pk for user in users.values()]
+        ).values_list('user_id', flat=True))
+
+        results = []
+        invites = []
+        invited = set()
+        for handle in handles:
+            user = users.get(handle.strip().lower())
+            email = handle.strip() if '@' in handle else ""
+
+            # users may be listed by both email and username
+            target = user.pk if user is not None else email.lower()
+
+            if user is not None and user.pk in members:
+                result = "member"
+            elif user is None and not email:
+                result = "invalid"
+            elif target in invited:
+                result = "duplicate"
+            else:
+                invited.add(target)
+                invites.append(inviteclass(
+                    user=user, inviter=self.request.user, email=email,
+                    role=role, strict=strict, organization=org,
+                    token=str(uuid.uuid4())))
+                result = "invited"
+
+            results.append({"handle": handle, "result": result})
+
+        # the invites exist once committed, failing to mail them must not
+        # fail the request
+        with mail_batch(fail_silently=True), atomic_signals():
+            if is_stateless_invite():
+                sign_invites(invites)
+            else:
+                inviteclass.objects.bulk_create(invites)
+                if invites and invites[0].pk is None:
+                    # not every database reports the primary keys of bulk
+                    # inserts, signals (and the outbox) need them
+                    invites = inviteclass.objects.filter(
+                        token__in=[invite.token for invite in invites]
+                    ).select_related('user', 'inviter')
+
+            sends = []
+            for invite in invites:
+                if invite.user and invite.user.is_active:
+                    signal = user_existing_invite
+                else:
+                    signal = user_email_invite
+                sends.append((signal, org, {'invite': invite}))
+            send_bulk(sends)
+
+        return Response({"results": results})
+
+
+class OrganizationJoin(InstrumentedViewMixin, APIView):
     serializer_class = JoinSerializer
     permission_classes = (IsAuthenticated, )
+    query_budget = {'POST': 9}
 
     def get_queryset(self):
         if self.request.user.is_superuser:
@@ -276,25 +505,81 @@ class OrganizationJoin(APIView):
                 status=status.HTTP_400_BAD_REQUEST)
 
         data = deserialized.data
+        token = data['token'].strip()
 
-        inviteclass = modelresolver('Invite')
-        membershipclass = modelresolver('Membership')
+        if is_signed_invite_token(token):
+            return self.join_signed(token, data['action'])
 
-        try:
-            invite = inviteclass.objects.get(token=data['token'])
-        except inviteclass.DoesNotExist:
+        inviteclass = modelresolver.models.Invite
+
+        with transaction.atomic():
+            # lock the invite, concurrent accepts of the same token wait
+            # for each other and only the first one finds the invite
+            try:
+                invite = inviteclass.objects.select_for_update().get(
+                    token=token.lower())
+            except inviteclass.DoesNotExist:
+                raise Http404()
+
+            if data['action'] == self.serializer_class.JOIN_ACCEPT:
+                if not self.join(invite):
+                    return response.Response(
+                        {"non_field_errors": ["User is already member"]},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+            invite.delete()
+
+        return Response({"status": "ok"})
+
+    def join_signed(self, token, action):
+        """ accept or reject a signed invite token. The token is checked
+            without a lookup and consumed by recording its id as revoked;
+            an id that is already recorded was used or cancelled.
+        """
+        loaded = load_invite_token(token)
+        if loaded is None:
             raise Http404()
+        jti, invite = loaded
 
-        if data['action'] == self.serializer_class.JOIN_ACCEPT:
-            m, c = membershipclass.objects.get_or_create(
-                user=self.request.user,
-                organization=invite.organization)
-            if not c:
-                return response.Response(
-                    {"non_field_errors": ["User is already member"]},
-                    status=status.HTTP_400_BAD_REQUEST)
-            m.role = invite.role
-            m.save()
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    RevokedInvite.objects.create(jti=jti)
+            except IntegrityError:
+                raise Http404()
+
+            if action == self.serializer_class.JOIN_ACCEPT:
+                if not self.join(invite):
+                    # keep the token usable
+                    transaction.set_rollback(True)
+                    return response.Response(
+                        {"non_field_errors": ["User is already member"]},
+                        status=status.HTTP_400_BAD_REQUEST)
 
-        invite.delete()
         return Response({"status": "ok"})
+
+    def join(self, invite):
+        """ make the user a member as invited, returns False if the user
+            already is a member. Raises Http404 if the organization no
+            longer exists """
+        membershipclass = modelresolver.models.Membership
+
+        # rely on the (user, organization) constraint, a separate
+        # membership check would race with concurrent joins
+        try:
+            with transaction.atomic():
+                membershipclass.objects.create(
+                    user=self.request.user,
+                    organization_id=invite.organization_id,
+                    role=invite.role)
+        except IntegrityError:
+            # only a violation of that constraint means "already member"
+            if membershipclass.objects.filter(
+                    user=self.request.user,
+                    organization_id=invite.organization_id).exists():
+                return False
+            if not modelresolver.models.Organization.objects.filter(
+                    pk=invite.organization_id).exists():
+                raise Http404()
+            raise
+        return True